@@ -0,0 +1,239 @@
+"""
+Microbenchmarks for the hot paths of tree growth. Every benchmark is run for
+a grid of data sizes N, dimensions D, numbers of states K, numbers of
+actions A and methods, and the results are written to a JSON file together
+with the current commit, so that runs for different commits can be compared:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json
+    python benchmark.py --compare before.json after.json
+
+Data is generated (a random walk in the unit cube), nothing is downloaded.
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import sys
+import timeit
+
+import entropy_utils
+import split_params
+import worldmodel
+
+
+# default grid and a small one for a quick check ('predictive' pairs the
+# actions 0/1 and 2/3 and thus needs either one or more than two actions).
+# the degree-5 expansion of 'fast' and 'predictive' fails numerically for 
+# small leaves, such configurations are reported with their error.
+GRID = {'N': [2000, 20000],
+        'D': [2, 3],
+        'K': [4, 16],
+        'A': [1, 4],
+        'method': ['naive', 'fast', 'predictive']}
+
+QUICK_GRID = {'N': [1000],
+              'D': [2],
+              'K': [4],
+              'A': [4],
+              'method': ['naive', 'fast', 'predictive']}
+
+
+def generate_data(N, D, A, seed=0):
+    """
+    Returns N samples of a random walk in the D-dimensional unit cube and
+    N-1 random actions out of A.
+    """
+    random = np.random.RandomState(seed)
+    data = np.cumsum(random.randn(N, D) * .05, axis=0) % 1.
+    actions = random.randint(A, size=N-1)
+    return data, actions
+
+
+def time_function(function, setup=None, repeat=5):
+    """
+    Calls function repeat times (with the result of setup as argument,
+    setup is not timed) and returns the list of wall times in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = timeit.default_timer()
+        function(*args)
+        times.append(timeit.default_timer() - start)
+    return times
+
+
+def grow_model(N, D, K, A, method, seed=0):
+    """
+    Returns a model for generated data where the partitioning of action 0
+    was split into K states (or less if no more splits are possible).
+    """
+    data, actions = generate_data(N=N, D=D, A=A, seed=seed)
+    model = worldmodel.Worldmodel(method=method, seed=seed)
+    model.add_data(data=data, actions=actions)
+    partitioning = model.get_partitioning(0)
+    while partitioning.tree.get_number_of_leaves() < K:
+        split = partitioning.calc_best_split()
+        if split is None or split._test_params is None:
+            break
+        split.apply()
+    return model
+
+
+def _reset_splits(partitioning):
+    """
+    Drops all cached split parameters (and whitened data), so that the next
+    calc_best_split() evaluates every leaf from scratch.
+    """
+    for leaf in partitioning.tree.get_leaves():
+        leaf._cached_split_params = None
+        partitioning._changed_leaves.add(leaf)
+    partitioning.model.whitening_cache.clear()
+    return
+
+
+def run_config(N, D, K, A, method, repeat=5, seed=0):
+    """
+    Runs all benchmarks for one configuration and returns a list of result
+    dictionaries.
+    """
+
+    config = {'N': N, 'D': D, 'K': K, 'A': A, 'method': method}
+    data, actions = generate_data(N=N, D=D, A=A, seed=seed)
+    results = []
+
+    def add_result(name, times):
+        result = dict(config)
+        result.update({'benchmark': name,
+                       'min': min(times),
+                       'median': float(np.median(times)),
+                       'repeat': len(times)})
+        results.append(result)
+
+    # adding data to an empty model
+    def new_model():
+        return worldmodel.Worldmodel(method=method, seed=seed)
+    add_result('add_data', time_function(lambda model: model.add_data(data=data, actions=actions), setup=new_model, repeat=repeat))
+
+    # a model with K states, its largest leaf and the test parameters for it
+    model = grow_model(N=N, D=D, K=K, A=A, method=method, seed=seed)
+    partitioning = model.get_partitioning(0)
+    config['states'] = partitioning.tree.get_number_of_leaves()
+    leaf = max(partitioning.tree.get_leaves(), key=lambda leaf: leaf.get_number_of_samples())
+    test_params = split_params.SplitParamsLocalGain(node=leaf)._test_params
+
+    # evaluating all leaves
+    add_result('calc_best_split', time_function(lambda _: partitioning.calc_best_split(), setup=lambda: _reset_splits(partitioning), repeat=repeat))
+
+    # phases of a split (for given test parameters)
+    def new_split():
+        return split_params.SplitParamsLocalGain(node=leaf, test_params=test_params)
+    def new_split_with_labels():
+        split = new_split()
+        split.get_new_labels()
+        return split
+    add_result('get_gain', time_function(lambda split: split.get_gain(), setup=new_split, repeat=repeat))
+    add_result('get_new_labels', time_function(lambda split: split.get_new_labels(), setup=new_split, repeat=repeat))
+    add_result('get_new_transition_matrices', time_function(lambda split: split.get_new_transition_matrices(), setup=new_split_with_labels, repeat=repeat))
+
+    # classification of N samples by the tree
+    add_result('classify', time_function(lambda: partitioning.classify(data), repeat=repeat))
+
+    # mutual information of the (merged) KxK transition matrix
+    P = partitioning.get_merged_transition_matrices()
+    add_result('mutual_information', time_function(lambda: entropy_utils.mutual_information(P), repeat=repeat))
+    return results
+
+
+def get_commit():
+    """
+    Returns the hash of the current git commit or None.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull, cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(grid=GRID, repeat=5, verbose=True):
+    """
+    Runs the benchmarks for every configuration in the grid and returns the
+    results together with information about the environment.
+    """
+
+    results = []
+    keys = ['N', 'D', 'K', 'A', 'method']
+    for values in itertools.product(*[grid[key] for key in keys]):
+        config = dict(zip(keys, values))
+        try:
+            config_results = run_config(repeat=repeat, **config)
+        except Exception as e:
+            # e.g., singular covariance matrices for unlucky data
+            config.update({'error': repr(e)})
+            config_results = [config]
+        results += config_results
+        if verbose:
+            for result in config_results:
+                print _format_result(result)
+            sys.stdout.flush()
+
+    return {'commit': get_commit(),
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'grid': grid,
+            'results': results}
+
+
+def _result_key(result):
+    return (result.get('benchmark'), result['method'], result['N'], result['D'], result['K'], result['A'])
+
+
+def _format_config(result):
+    return '%-28s %-11s N=%-6d D=%-2d K=%-4d A=%-2d' % (result.get('benchmark', 'error'), result['method'], result['N'], result['D'], result['K'], result['A'])
+
+
+def _format_result(result):
+    if 'error' in result:
+        return '%s  %s' % (_format_config(result), result['error'])
+    return '%s  %10.6fs' % (_format_config(result), result['min'])
+
+
+def compare(results_1, results_2):
+    """
+    Prints the ratio of the minimal times (second / first) for all
+    benchmarks that are in both results.
+    """
+    times_1 = dict([(_result_key(r), r['min']) for r in results_1['results'] if 'min' in r])
+    for result in results_2['results']:
+        key = _result_key(result)
+        if key in times_1 and 'min' in result:
+            print '%s  %10.6fs -> %10.6fs  (x%.2f)' % (_format_config(result), times_1[key], result['min'], result['min'] / max(times_1[key], 1e-12))
+    return
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Runs microbenchmarks for the worldmodel.')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file for the results')
+    parser.add_argument('--repeat', type=int, default=5, help='number of repetitions per benchmark')
+    parser.add_argument('--quick', action='store_true', help='run a small grid only')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(json.load(open(args.compare[0])), json.load(open(args.compare[1])))
+    else:
+        results = run(grid=QUICK_GRID if args.quick else GRID, repeat=args.repeat)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
@@ -0,0 +1,26 @@
+import json
+import unittest
+
+import benchmark
+
+
+class Test(unittest.TestCase):
+
+
+    def testRun(self):
+        # every benchmark gives a (serializable) result for a tiny grid
+        grid = {'N': [300], 'D': [2], 'K': [3], 'A': [1, 3], 'method': ['naive']}
+        results = benchmark.run(grid=grid, repeat=2, verbose=False)
+        results = json.loads(json.dumps(results))
+        self.failUnless(len(results['results']) == 2 * 7)
+        for result in results['results']:
+            self.failIf('error' in result)
+            self.failUnless(result['repeat'] == 2)
+            self.failUnless(0 <= result['min'] <= result['median'])
+        self.failUnless(set([r['benchmark'] for r in results['results']]) == set(['add_data', 'calc_best_split', 'get_gain', 'get_new_labels', 'get_new_transition_matrices', 'classify', 'mutual_information']))
+        return
+
+
+
+if __name__ == "__main__":
+    unittest.main()
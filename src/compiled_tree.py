@@ -0,0 +1,128 @@
+import numpy as np
+
+
+class CompiledTree(object):
+    """
+    A flat copy of a WorldmodelTree that is used for classification. Nodes are
+    numbered (the root being 0) and stored in parallel arrays: the indices of
+    the two children (-1 for leaves), the test parameters (None for leaves)
+    and the leaf index (-1 for inner nodes). Thus, classifying data never
+    touches the node objects.
+    """
+
+    def __init__(self, tree):
+        assert tree.get_root() is tree
+        self._test_batch = tree._test_batch
+        self.children = None
+        self.test_params = None
+        self.leaf_ids = None
+        self.leaf_nodes = None
+        self.rebuild(tree)
+        return
+
+
+    def rebuild(self, tree):
+        """
+        Compiles the whole tree from scratch (in breadth-first order).
+        """
+
+        assert tree.get_root() is tree
+
+        nodes = [tree]
+        for node in nodes:
+            nodes += node._children
+        node_ids = dict(zip(nodes, range(len(nodes))))
+
+        n = len(nodes)
+        self.children = -np.ones((n, 2), dtype=int)
+        self.test_params = [None] * n
+        self.leaf_ids = -np.ones(n, dtype=int)
+
+        for i, node in enumerate(nodes):
+            if not node.is_leaf():
+                self.children[i] = [node_ids[child] for child in node._children]
+                self.test_params[i] = node._split_params._test_params
+
+        leaves = tree.get_leaves()
+        self.leaf_nodes = np.array([node_ids[leaf] for leaf in leaves], dtype=int)
+        self.leaf_ids[self.leaf_nodes] = np.arange(len(leaves))
+        return
+
+
+    @classmethod
+    def from_arrays(cls, test_batch, children, test_params, leaf_ids):
+        """
+        Creates a compiled tree from its arrays (e.g., loaded from a file)
+        without a WorldmodelTree. test_batch is the test function of the 
+        tree's class.
+        """
+        compiled = cls.__new__(cls)
+        compiled._test_batch = test_batch
+        compiled.children = np.asarray(children, dtype=int)
+        compiled.test_params = list(test_params)
+        compiled.leaf_ids = np.asarray(leaf_ids, dtype=int)
+        leaves = np.nonzero(compiled.leaf_ids >= 0)[0]
+        compiled.leaf_nodes = np.empty(len(leaves), dtype=int)
+        compiled.leaf_nodes[compiled.leaf_ids[leaves]] = leaves
+        return compiled
+
+
+    def get_number_of_leaves(self):
+        return len(self.leaf_nodes)
+
+
+    def split_leaf(self, leaf_index, test_params):
+        """
+        Patches the arrays for a leaf that was split into two new leaves with
+        indices leaf_index and leaf_index+1.
+        """
+
+        node = self.leaf_nodes[leaf_index]
+        n = len(self.leaf_ids)
+
+        # leaf becomes inner node
+        self.children[node] = [n, n+1]
+        self.test_params[node] = test_params
+        self.leaf_ids[self.leaf_ids > leaf_index] += 1
+        self.leaf_ids[node] = -1
+
+        # two new leaves
+        self.children = np.vstack([self.children, -np.ones((2, 2), dtype=int)])
+        self.test_params += [None, None]
+        self.leaf_ids = np.hstack([self.leaf_ids, [leaf_index, leaf_index+1]])
+        self.leaf_nodes = np.hstack([self.leaf_nodes[:leaf_index], [n, n+1], self.leaf_nodes[leaf_index+1:]])
+        return
+
+
+    def classify(self, x):
+        """
+        Returns the leaf index for every row of x.
+        """
+
+        assert x.ndim == 2
+
+        N, _ = x.shape
+        labels = np.zeros(N, dtype=int)
+
+        stack = [(0, np.arange(N))]
+        while stack:
+
+            node, indices = stack.pop()
+
+            if self.leaf_ids[node] >= 0:
+                labels[indices] = self.leaf_ids[node]
+                continue
+
+            if len(indices) == 0:
+                continue
+
+            child_indices = self._test_batch(x[indices], params=self.test_params[node])
+            for i, child in enumerate(self.children[node]):
+                stack.append((child, indices[child_indices == i]))
+
+        return labels
+
+
+
+if __name__ == '__main__':
+    pass
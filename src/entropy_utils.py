@@ -1,5 +1,6 @@
 import numpy as np
 import scipy.linalg
+import scipy.sparse
 import scipy.sparse.linalg
 
 
@@ -11,9 +12,8 @@ def entropy(x, normalize=False, ignore_empty_classes=True):
 
     # invalid input?
     assert x.ndim == 1
-    assert True not in list(x < -1e-6)
-    assert float("nan") not in x
-    assert float("inf") not in x
+    assert not np.any(x < -1e-6)
+    assert np.all(np.isfinite(x))
 
     # useful variables
     trans_sum = np.sum(x)
@@ -48,6 +48,188 @@ def entropy(x, normalize=False, ignore_empty_classes=True):
     return entropy
 
 
+def row_entropies(X, normalize=False):
+    """
+    Calculates the (normalized) entropy of every row of X, i.e., along the 
+    last axis, in one pass. X may be a matrix, a stack of matrices (3D) or a
+    sparse matrix. For dense input, results are identical to entropy() 
+    applied to every row.
+    """
+    
+    # invalid input?
+    if scipy.sparse.issparse(X):
+        assert X.ndim == 2
+        assert not np.any(X.data < -1e-6)
+        assert np.all(np.isfinite(X.data))
+    else:
+        X = np.asarray(X)
+        assert X.ndim >= 1
+        assert not np.any(X < -1e-6)
+        assert np.all(np.isfinite(X))
+        
+    # only one class?
+    K = X.shape[-1]
+    if K <= 1:
+        return np.ones(X.shape[:-1])
+    
+    # the actual calculation
+    if scipy.sparse.issparse(X):
+        entropies = _sparse_row_entropies(X)
+    else:
+        entropies = _row_entropies(X)
+
+    # normalization?
+    assert np.all(entropies <= np.log2(K) + 1e-6)
+    if normalize:
+        entropies /= np.log2(K)
+        
+    assert np.all(entropies >= 0)
+    return entropies
+
+
+def _row_entropies(X):
+    """
+    Calculates the (not normalized) entropy of every row of X, i.e., along 
+    the last axis, with the same arithmetic as entropy().
+    """
+    
+    K = X.shape[-1]
+    if K <= 1:
+        return np.ones(X.shape[:-1])
+    
+    trans_sums = np.sum(X, axis=-1)
+    empty = (trans_sums == 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        probs = np.array(X, dtype=np.float32) / np.array(trans_sums, dtype=np.float32)[...,np.newaxis]
+    probs[empty] = 0.
+    log_probs = np.zeros_like(probs)
+    log_probs[probs > 0.] = np.log2( probs[probs > 0.] )
+    entropies = np.array(-np.sum(probs * log_probs, axis=-1), dtype=np.float64)
+    
+    # empty classes
+    entropies[empty] = np.log2(K)
+    return entropies
+
+
+def _sparse_row_entropies(P):
+    """
+    Calculates the (not normalized) entropy of every row of the sparse 
+    matrix P, touching only the non-zero entries.
+    """
+    
+    P = scipy.sparse.csr_matrix(P, dtype=np.float64)
+    K = P.shape[1]
+    if K <= 1:
+        return np.ones(P.shape[0])
+    
+    trans_sums = np.asarray(P.sum(axis=1)).ravel()
+    rows = np.repeat(np.arange(P.shape[0]), np.diff(P.indptr))
+    probs = P.data / trans_sums[rows]
+    terms = np.zeros_like(probs)
+    terms[probs > 0.] = -probs[probs > 0.] * np.log2( probs[probs > 0.] )
+    entropies = np.array(np.bincount(rows, weights=terms, minlength=P.shape[0]), dtype=np.float64)
+    
+    # empty classes
+    entropies[trans_sums == 0] = np.log2(K)
+    return entropies
+
+
+def _smoothed_row_sums(P):
+    """
+    Returns the row sums of the float (dense or CSR) matrix P with 1e-6 
+    added to every entry.
+    """
+    return np.asarray(P.sum(axis=1)).ravel() + 1e-6 * P.shape[1]
+
+
+def _stationary_distribution_operator(P):
+    """
+    Calculates the (unnormalized) stationary distribution of the float 
+    (dense or CSR) transition counts P with 1e-6 added to every count by 
+    ARPACK. P is never made dense: Q.T is applied as an operator.
+    """
+    N = P.shape[0]
+    d = _smoothed_row_sums(P)
+    PT = P.T.tocsr() if scipy.sparse.issparse(P) else P.T
+    def matvec(x):
+        x = np.ravel(x) / d
+        return PT.dot(x) + 1e-6 * np.sum(x)
+    Q_T = scipy.sparse.linalg.LinearOperator((N, N), matvec=matvec, dtype=np.float64)
+    E, U = scipy.sparse.linalg.eigs(Q_T, k=1, which='LR')
+    assert abs(E[0].real - 1) < 1e-6
+    return U[:,0].real
+
+
+def _stationary_distribution(P):
+    """
+    Calculates the stationary distribution of the Markov chain given by the
+    transition counts P (dense or sparse), with 1e-6 added to every count.
+    """
+    
+    N = P.shape[0]
+    
+    # sparse matrices are never made dense
+    if scipy.sparse.issparse(P) and N > 2:
+        return _stationary_distribution_operator(scipy.sparse.csr_matrix(P, dtype=np.float64))
+    
+    if scipy.sparse.issparse(P):
+        P = P.toarray()
+        
+    Q = P + 1e-6
+    d = np.sum(Q, axis=1)
+    Q = Q / d[:,np.newaxis]
+    if N <= 2:
+        E, U = scipy.linalg.eig(Q.T)
+        idx = np.argsort(E.real)
+        assert abs(E[idx[-1]].real - 1) < 1e-6
+        mu = U[:,idx[-1]].real
+    else:
+        E, U = scipy.sparse.linalg.eigs(Q.T, k=1, which='LR')
+        assert abs(E[0].real - 1) < 1e-6
+        mu = U[:,0].real
+    return mu
+
+
+def stationary_distribution(P, mu0=None, tolerance=1e-12):
+    """
+    Calculates the (normalized) stationary distribution of the Markov chain 
+    given by the transition counts P (dense or sparse), with 1e-6 added to 
+    every count. Then mu = D y for the solution of the regular linear system 
+    (D - P.T) y = 1 where D holds the row sums. Starting from the result for
+    a similar matrix (mu0), e.g. before a split, BiCGSTAB converges fast. 
+    Without mu0 (or if it doesn't converge), ARPACK is used.
+    """
+    
+    N = P.shape[0]
+    if N <= 2:
+        mu = _stationary_distribution(P)
+        return mu / np.sum(mu)
+    
+    # row sums and linear system
+    if scipy.sparse.issparse(P):
+        P = scipy.sparse.csr_matrix(P, dtype=np.float64)
+        d = _smoothed_row_sums(P)
+        A = (scipy.sparse.diags(d) - P.T).tocsr()
+    else:
+        P = np.array(P, dtype=np.float64)
+        d = _smoothed_row_sums(P)
+        A = np.diag(d) - P.T
+    
+    # warm start (y sums up to 1/1e-6)
+    if mu0 is not None and len(mu0) == N and np.all(np.isfinite(mu0)) and np.sum(mu0) > 0:
+        y0 = np.array(mu0, dtype=np.float64) / d
+        y0 /= np.sum(y0) * 1e-6
+        M = scipy.sparse.diags(1. / d)
+        y, info = scipy.sparse.linalg.bicgstab(A, np.ones(N), x0=y0, tol=tolerance, M=M)
+        if info == 0 and np.all(y > 0):
+            mu = d * y
+            return mu / np.sum(mu)
+        
+    # ARPACK
+    mu = _stationary_distribution_operator(P)
+    return mu / np.sum(mu)
+
+
 def entropy_rate(P, mu=None, normalize=False):
     """
     Calculates the entropy rate for a given transition matrix, i.e. the 
@@ -62,38 +244,57 @@ def entropy_rate(P, mu=None, normalize=False):
     
     # mu
     if mu is None:
-        Q = P + 1e-6
-        d = np.sum(Q, axis=1)
-        Q = Q / d[:,np.newaxis]
-        if N <= 2:
-            E, U = scipy.linalg.eig(Q.T)
-            idx = np.argsort(E.real)
-            assert abs(E[idx[-1]].real - 1) < 1e-6
-            mu = U[:,idx[-1]].real
-        else:
-            E, U = scipy.sparse.linalg.eigs(Q.T, k=1, which='LR')
-            assert abs(E[0].real - 1) < 1e-6
-            mu = U[:,0].real
+        mu = _stationary_distribution(P)
         
     # normalize mu
+    mu = np.array(mu, dtype=np.float64)
     assert mu.ndim == 1
     mu /= np.sum(mu)
     
-    # row entropies
-    row_entropies = np.zeros(N)
-    for i in range(N):
-        if mu[i] > 0:
-            row_entropies[i] = entropy(P[i], normalize=normalize)
+    # row entropies of sparse matrices
+    if scipy.sparse.issparse(P):
+        entropies = row_entropies(P, normalize=normalize)
+        return np.sum(mu * entropies)
+    
+    # row entropies (only needed for states with mu > 0)
+    entropies = np.zeros(N)
+    rows = (mu > 0)
+    if np.all(rows):
+        entropies = row_entropies(P, normalize=normalize)
+    elif np.any(rows):
+        entropies[rows] = row_entropies(P[rows], normalize=normalize)
 
     # weighted average
-    h = np.sum(mu * row_entropies)
+    h = np.sum(mu * entropies)
     return h
 
 
-def mutual_information(P, naive_station_dist=False, verbose=False):
+def entropy_rate_stack(P, mu, normalize=False):
+    """
+    Calculates the entropy rate for every transition matrix in the stack P 
+    (a 3D array) at once. mu is the stationary distribution, either for all
+    matrices or one per matrix (as 2D array).
+    """
+    
+    # valid input?
+    assert P.ndim == 3
+    _, N, M = P.shape
+    assert N == M
+    assert mu.shape[-1] == N
+    
+    # normalize mu
+    mu = np.array(mu, dtype=np.float64)
+    mu /= np.sum(mu, axis=-1)[...,np.newaxis]
+    
+    # weighted average of row entropies
+    return np.sum(mu * row_entropies(P, normalize=normalize), axis=-1)
+
+
+def mutual_information(P, naive_station_dist=False, verbose=False, mu=None):
     """
     Calculates the mutual information between t and t+1 for a model given
-    as transition matrix P.
+    as transition matrix P. The stationary distribution mu is calculated 
+    unless it is given.
     """
      
     # valid inuput?
@@ -104,21 +305,12 @@ def mutual_information(P, naive_station_dist=False, verbose=False):
     assert N == M
      
     # prepare stationary distribution mu
-    if naive_station_dist:
+    if mu is not None:
+        mu = np.array(mu, dtype=np.float64)
+    elif naive_station_dist:
         mu = np.ones(N)
     else:
-        Q = P + 1e-6
-        d = np.sum(Q, axis=1)
-        Q = Q / d[:,np.newaxis]
-        if N <= 2:
-            E, U = scipy.linalg.eig(Q.T)
-            idx = np.argsort(E.real)
-            assert abs(E[idx[-1]].real - 1) < 1e-6
-            mu = U[:,idx[-1]].real
-        else:
-            E, U = scipy.sparse.linalg.eigs(Q.T, k=1, which='LR')
-            assert abs(E[0].real - 1) < 1e-6
-            mu = U[:,0].real
+        mu = _stationary_distribution(P)
     mu /= np.sum(mu)
          
     # the actual calculation
@@ -133,6 +325,28 @@ def mutual_information(P, naive_station_dist=False, verbose=False):
         print 'mutual information: %f' % (mi)
     return mi
 
+
+def mutual_information_stack(P):
+    """
+    Calculates the mutual information for every transition matrix in the 
+    stack P (a 3D array) at once. Like mutual_information() with 
+    naive_station_dist=True.
+    """
+    
+    # valid input?
+    assert P.ndim == 3
+    _, N, M = P.shape
+    assert N == M
+    
+    # uniform stationary distribution
+    mu = np.ones(N)
+    mu /= np.sum(mu)
+    
+    # the actual calculation
+    h_mu = entropy(mu)
+    h_p = entropy_rate_stack(P, mu=mu)
+    return h_mu - h_p
+
     
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse
 import unittest
 
 import entropy_utils
@@ -96,6 +97,7 @@ class VectorEntropyTests(unittest.TestCase):
         self.failUnlessAlmostEqual(entropy_utils.entropy_rate(P, mu, normalize=False), 0.98522818088531494, 6)        
         mu = np.array([1., 1.])
         self.failUnlessAlmostEqual(entropy_utils.entropy_rate(P, mu, normalize=False), 0.95176196098327637, 6)        
+        self.failUnless(np.array_equal(mu, [1., 1.]))
         self.failUnlessAlmostEqual(entropy_utils.entropy_rate(P, mu=None, normalize=False), 0.95903722276316206, 6)
         
         P = np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9]])        
@@ -120,6 +122,61 @@ class VectorEntropyTests(unittest.TestCase):
         self.failUnlessAlmostEqual(entropy_utils.mutual_information(P), 0.012238804751254495)
         
         return
+    
+    
+    def testSparseMatrices(self):
+        """
+        Sparse matrices have to give the same results as dense ones.
+        """
+        
+        for K in [1, 2, 5, 20]:
+            P = np.random.randint(4, size=(K, K)) * (np.random.random((K, K)) < .3)
+            P[0] = 0
+            P_sparse = scipy.sparse.csr_matrix(P)
+            self.failUnlessAlmostEqual(entropy_utils.entropy_rate(P_sparse, mu=np.ones(K)), entropy_utils.entropy_rate(P, mu=np.ones(K)), 6)
+            self.failUnlessAlmostEqual(entropy_utils.entropy_rate(P_sparse, mu=np.ones(K), normalize=True), entropy_utils.entropy_rate(P, mu=np.ones(K), normalize=True), 6)
+            self.failUnlessAlmostEqual(entropy_utils.mutual_information(P_sparse), entropy_utils.mutual_information(P), 6)
+        
+        return
+    
+    
+    def testRowEntropies(self):
+        """
+        Vectorized kernels have to give exactly the results of entropy().
+        """
+        
+        for K in [1, 2, 5, 20]:
+            for P in [np.random.randint(4, size=(3, K, K)), 10 * np.random.random((3, K, K))]:
+                P[0,0] = 0
+                for normalize in [False, True]:
+                    entropies = entropy_utils.row_entropies(P, normalize=normalize)
+                    for a in range(3):
+                        for i in range(K):
+                            self.assertEqual(entropies[a,i], entropy_utils.entropy(P[a,i], normalize=normalize))
+                        mu = np.random.random(K)
+                        self.assertEqual(entropy_utils.entropy_rate_stack(P, mu=mu, normalize=normalize)[a], np.sum(mu / np.sum(mu) * entropies[a]))
+                        
+        # invalid input
+        self.assertRaises(AssertionError, entropy_utils.row_entropies, -np.ones((2, 2)))
+        self.assertRaises(AssertionError, entropy_utils.row_entropies, np.ones((2, 2)) * np.nan)
+        return
+
+
+    def testStationaryDistribution(self):
+        """
+        Linear solver (with and without start) has to agree with the 
+        eigenvector solution.
+        """
+        
+        for K in [1, 2, 5, 50]:
+            P = np.random.randint(5, size=(K, K))
+            P[0] = 0
+            mu = entropy_utils._stationary_distribution(P)
+            mu /= np.sum(mu)
+            for Q in [P, scipy.sparse.csr_matrix(P)]:
+                for mu0 in [None, np.ones(K), mu]:
+                    self.assertTrue(np.allclose(entropy_utils.stationary_distribution(Q, mu0=mu0), mu))
+        return
 
 
 if __name__ == "__main__":
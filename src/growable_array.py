@@ -0,0 +1,121 @@
+import numpy as np
+import os
+
+
+class GrowableArray(object):
+    """
+    An array that grows along its first axis. Memory is allocated with
+    doubling capacity, so appending is amortized O(1) per row and get()
+    returns a view of the filled part without copying.
+    """
+
+    def __init__(self, dtype, shape=(), capacity=16):
+        self._buffer = np.empty((capacity,) + tuple(shape), dtype=dtype)
+        self._size = 0
+        return
+
+
+    def __len__(self):
+        return self._size
+
+
+    def get(self):
+        """
+        Returns a view of the filled part of the buffer.
+        """
+        return self._buffer[:self._size]
+
+
+    def _reserve(self, capacity, dtype):
+        """
+        Makes sure that the buffer can hold the given number of rows with the
+        given dtype.
+        """
+        if capacity <= len(self._buffer) and dtype == self._buffer.dtype:
+            return
+        new_capacity = len(self._buffer)
+        while new_capacity < capacity:
+            new_capacity = max(2 * new_capacity, 1)
+        new_buffer = np.empty((new_capacity,) + self._buffer.shape[1:], dtype=dtype)
+        new_buffer[:self._size] = self._buffer[:self._size]
+        self._buffer = new_buffer
+        return
+
+
+    def append(self, values):
+        """
+        Appends the rows of values. The dtype of the buffer is widened if
+        necessary.
+        """
+        values = np.asarray(values)
+        n = len(values)
+        if n == 0:
+            return
+        dtype = np.result_type(self._buffer.dtype, values.dtype)
+        self._reserve(self._size + n, dtype=dtype)
+        self._buffer[self._size:self._size+n] = values
+        self._size += n
+        return
+
+
+    def set(self, values):
+        """
+        Replaces the whole content with values.
+        """
+        self._size = 0
+        self.append(values)
+        return
+
+
+
+
+class MemmapArray(GrowableArray):
+    """
+    A GrowableArray that keeps its content in a memory-mapped file. Growing
+    only extends the file and maps it again, old content is never read. The
+    dtype is fixed, appended values are cast to it. An existing file is only
+    replaced with overwrite.
+    """
+
+    def __init__(self, filename, dtype, shape=(), capacity=1024, overwrite=False):
+        if not overwrite and os.path.exists(filename):
+            raise IOError('%s exists already' % filename)
+        self._filename = filename
+        self._buffer = None
+        self._size = 0
+        self._dtype = np.dtype(dtype)
+        self._shape = tuple(shape)
+        open(filename, 'wb').close()
+        self._reserve(capacity, dtype=self._dtype)
+        return
+
+
+    def _reserve(self, capacity, dtype):
+        """
+        Makes sure that the file can hold the given number of rows.
+        """
+        if self._buffer is not None and capacity <= len(self._buffer):
+            return
+        new_capacity = 1 if self._buffer is None else len(self._buffer)
+        while new_capacity < capacity:
+            new_capacity *= 2
+        if self._buffer is not None:
+            self._buffer.flush()
+        row_size = self._dtype.itemsize * int(np.prod(self._shape))
+        with open(self._filename, 'r+b') as f:
+            f.truncate(new_capacity * row_size)
+        self._buffer = np.memmap(self._filename, dtype=self._dtype, mode='r+', shape=(new_capacity,) + self._shape)
+        return
+
+
+    def flush(self):
+        """
+        Writes changes to disk.
+        """
+        self._buffer.flush()
+        return
+
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,79 @@
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+
+import growable_array
+
+
+class Test(unittest.TestCase):
+
+
+    def testAppend(self):
+        # append rows one by one and in chunks
+        data = np.random.random((100, 3))
+        array = growable_array.GrowableArray(dtype=data.dtype, shape=(3,), capacity=1)
+        array.append(data[:1])
+        for i in range(1, 50):
+            array.append(data[i:i+1])
+        array.append(data[50:])
+        self.failUnless(len(array) == 100)
+        self.failUnless(np.array_equal(array.get(), data))
+        
+        # view of filled part does not change when appending
+        view = array.get()
+        array.append(data)
+        self.failUnless(np.array_equal(view, data))
+        self.failUnless(np.array_equal(array.get(), np.vstack([data, data])))
+        return
+    
+    
+    def testDtype(self):
+        # integer buffer is widened for float values
+        array = growable_array.GrowableArray(dtype=int)
+        array.append([1, 2, 3])
+        array.append([])
+        self.failUnless(array.get().dtype == int)
+        array.append([.5])
+        self.failUnless(np.array_equal(array.get(), [1, 2, 3, .5]))
+        
+        # replace content
+        array.set([4, 5])
+        self.failUnless(np.array_equal(array.get(), [4, 5]))
+        return
+    
+    
+    
+    def testMemmap(self):
+        # same as in memory, but file-backed
+        data = np.random.random((100, 3))
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'data')
+            array = growable_array.MemmapArray(filename=filename, dtype=np.float64, shape=(3,), capacity=1)
+            for i in range(10):
+                array.append(data[10*i:10*(i+1)])
+            self.failUnless(len(array) == 100)
+            self.failUnless(np.array_equal(array.get(), data))
+            array.flush()
+            stored = np.memmap(filename, dtype=np.float64, mode='r', shape=(100, 3))
+            self.failUnless(np.array_equal(stored, data))
+            del stored, array
+            
+            # existing files are only replaced with overwrite
+            self.assertRaises(IOError, growable_array.MemmapArray, filename=filename, dtype=np.float64, shape=(3,))
+            stored = np.memmap(filename, dtype=np.float64, mode='r', shape=(100, 3))
+            self.failUnless(np.array_equal(stored, data))
+            del stored
+            array = growable_array.MemmapArray(filename=filename, dtype=np.float64, shape=(3,), overwrite=True)
+            self.failUnless(len(array) == 0)
+            del array
+        finally:
+            shutil.rmtree(directory)
+        return
+    
+
+if __name__ == "__main__":
+    unittest.main()
+    
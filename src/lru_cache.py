@@ -0,0 +1,88 @@
+import collections
+import hashlib
+import numpy as np
+
+
+def array_key(array):
+    """
+    Returns a hashable key for the content of an array.
+    """
+    array = np.ascontiguousarray(array)
+    return (array.dtype.str, array.shape, hashlib.sha1(array.tostring()).hexdigest())
+
+
+
+class LRUCache(object):
+    """
+    A cache for tuples of arrays with a bounded size in bytes. When the cache
+    is full, the least recently used entries are evicted.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        return
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+    def get_size(self):
+        """
+        Returns the number of bytes of all cached arrays.
+        """
+        return self._bytes
+
+
+    def _sizeof(self, value):
+        return sum([getattr(v, 'nbytes', 0) for v in value])
+
+
+    def get(self, key):
+        """
+        Returns the value for key (and marks it as recently used) or None.
+        """
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        value = self._entries.pop(key)
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+
+    def put(self, key, value):
+        """
+        Stores a tuple of arrays (other items are stored as well but not
+        counted). Values larger than the whole cache are not stored.
+        """
+        if key in self._entries:
+            self._bytes -= self._sizeof(self._entries.pop(key))
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            return
+        while self._bytes + size > self.max_bytes:
+            _, old_value = self._entries.popitem(last=False)
+            self._bytes -= self._sizeof(old_value)
+        self._entries[key] = value
+        self._bytes += size
+        return
+
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+        return
+
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,40 @@
+import numpy as np
+import unittest
+
+import lru_cache
+
+
+class Test(unittest.TestCase):
+
+
+    def testEviction(self):
+        # least recently used entries are evicted first
+        a = np.zeros(10)
+        cache = lru_cache.LRUCache(max_bytes=3*a.nbytes)
+        for key in range(3):
+            cache.put(key, (a.copy(),))
+        self.failUnless(cache.get(0) is not None)
+        cache.put(3, (a.copy(),))
+        self.failUnless(0 in cache)
+        self.failIf(1 in cache)
+        self.failUnless(len(cache) == 3)
+        self.failUnless(cache.get_size() == 3*a.nbytes)
+
+        # too large for the cache
+        cache.put(4, (np.zeros(100),))
+        self.failIf(4 in cache)
+        self.failUnless(cache.get(4) is None)
+        return
+
+
+    def testArrayKey(self):
+        a = np.arange(10)
+        self.failUnless(lru_cache.array_key(a) == lru_cache.array_key(a.copy()))
+        self.failIf(lru_cache.array_key(a) == lru_cache.array_key(a[1:]))
+        self.failIf(lru_cache.array_key(a) == lru_cache.array_key(a[::-1]))
+        return
+
+
+
+if __name__ == "__main__":
+    unittest.main()
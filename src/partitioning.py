@@ -1,11 +1,51 @@
+import heapq
 import numpy as np
+import scipy.sparse
+import warnings
 import weakref
 
 from matplotlib import pyplot
 
+import compiled_tree
+import entropy_utils
+import growable_array
 import split_params
+import split_pool
 
 
+def calc_best_splits_in_parallel(model, actions):
+    """
+    Calculates the best split of the partitioning for each of the given 
+    actions. Split parameters of the (stale) leaves of all partitionings are
+    calculated at once in the model's pool of worker processes and then 
+    transferred back to the leaves. Returns a dictionary with the best split
+    for each action.
+    
+    Every worker has a whitening cache of its own. Leaves of different 
+    actions with the same data share whitened data only when they end up in
+    the same worker, so part of the whitening is repeated.
+    """
+    
+    stale = {}
+    tasks = []
+    for action in actions:
+        stale[action] = model.partitionings[action]._get_stale_leaves()
+        tasks += [(action, leaf.get_leaf_index()) for leaf in stale[action]]
+    results = model.get_split_pool().imap(tasks) if len(tasks) >= 2 else None
+    
+    # results are collected in the profiled phase of their action
+    best_splits = {}
+    for action in actions:
+        partitioning = model.partitionings[action]
+        with model.profiler.phase('calc_best_split', partitioning.tree, model.get_number_of_samples()):
+            if results is not None:
+                for leaf in stale[action]:
+                    partitioning._import_split_params(leaf, *next(results))
+            best_splits[action] = partitioning.calc_best_split(processes=1)
+    return best_splits
+    
+    
+
 class Partitioning(object):
     
     def __init__(self, model, active_action):#, tree, labels, transitions):
@@ -17,10 +57,178 @@ class Partitioning(object):
         
         N = model.get_number_of_samples()
         self.labels = np.zeros(N, dtype=int)
+        
+        # with a contiguous layout, the data references of all leaves are kept
+        # in one permutation, grouped by leaf. _offsets marks the borders.
+        self.contiguous_refs = model.contiguous_refs
+        self._permutation = None
+        self._offsets = None
+        if self.contiguous_refs:
+            self._permutation = np.arange(N)
+            self._offsets = np.array([0, N], dtype=int)
+            
         self.tree = self.model._tree_class(partitioning=self)
+        if not self.contiguous_refs:
+            self.tree.data_refs = np.arange(N)
+        self.tree._init_inside_refs()
+        self.compiled_tree = compiled_tree.CompiledTree(tree=self.tree)
+        
+        # candidate splits in a heap ordered by gain. leaves with new data are
+        # re-evaluated (and pushed again) only when the best split is requested
+        self._split_heap = []
+        self._split_heap_entries = {}
+        self._split_heap_counter = 0
+        self._changed_leaves = set([self.tree])
+        
+        # transition matrices (dense or sparse) for every action
+        self.sparse_transitions = model.sparse_transitions
         self.transitions = {}
         for action in self.model.get_known_actions():
-            self.transitions[action] = np.ones((1, 1), dtype=int) * np.count_nonzero(self.model.actions == action)
+            transitions = np.ones((1, 1), dtype=int) * np.count_nonzero(self.model.actions == action)
+            if self.sparse_transitions:
+                transitions = scipy.sparse.csr_matrix(transitions)
+            self.transitions[action] = transitions
+            
+        # stationary distributions for every action (and None for all) with 
+        # the version of the transitions they were calculated for
+        self.transitions_version = 0
+        self._stationary_distributions = {}
+            
+            
+    @property
+    def labels(self):
+        """
+        A view of the state labels of all data points.
+        """
+        return self._labels.get()
+    
+    
+    @labels.setter
+    def labels(self, labels):
+        # a new buffer, so that views of the old labels don't change
+        self._labels = growable_array.GrowableArray(dtype=int)
+        self._labels.append(labels)
+        
+        
+    def add_labels(self, labels):
+        """
+        Appends labels for new data points, which must have been added to the 
+        model already. References to the new data are distributed to the 
+        leaves and the new transitions are counted.
+        """
+        
+        first_data = len(self._labels)
+        first_source = max(first_data - 1, 0)
+        self._labels.append(labels)
+        
+        # helper variables
+        labels = self.labels
+        N = len(labels)
+        K = self.tree.get_number_of_leaves()
+        
+        # group new references by label
+        new_refs = np.argsort(labels[first_data:], kind='mergesort')
+        new_labels = labels[first_data:][new_refs]
+        new_refs += first_data
+        if self.contiguous_refs:
+            self._insert_refs(new_refs, new_labels)
+        borders = np.searchsorted(new_labels, np.arange(K+1))
+        for i, leaf in enumerate(self.tree.get_leaves()):
+            if borders[i] < borders[i+1]:
+                leaf.add_data_refs(new_refs[borders[i]:borders[i+1]])
+                self._changed_leaves.add(leaf)
+                
+        # count new transitions for all actions at once
+        action_list = sorted(self.transitions.keys())
+        A = len(action_list)
+        action_indices = np.searchsorted(action_list, self.model.actions[first_source:N-1])
+        sources = labels[first_source:N-1]
+        targets = labels[first_source+1:N]
+        self.transitions_version += 1
+        if self.sparse_transitions:
+            for i, action in enumerate(action_list):
+                mask = (action_indices == i)
+                counts = scipy.sparse.coo_matrix((np.ones(np.count_nonzero(mask), dtype=int), (sources[mask], targets[mask])), shape=(K, K))
+                self.transitions[action] = (self.transitions[action] + counts).tocsr()
+            return
+        counts = np.bincount((action_indices * K + sources) * K + targets, minlength=A*K*K)
+        counts = counts.reshape((A, K, K))
+        for i, action in enumerate(action_list):
+            self.transitions[action] += counts[i]
+        return
+            
+            
+    def add_label(self, label):
+        """
+        Appends the label of a single new data point, which must have been 
+        added to the model already. Same as add_labels() but in O(1).
+        """
+        ref = len(self._labels)
+        source = self._labels.get()[ref-1]
+        self._labels.append([label])
+        if self.contiguous_refs:
+            self._insert_refs(np.array([ref]), np.array([label]))
+        leaf = self.tree.get_leaf(label)
+        leaf.add_data_refs([ref])
+        self._changed_leaves.add(leaf)
+        with warnings.catch_warnings():
+            # a new entry in a sparse matrix is fine here
+            warnings.simplefilter('ignore', scipy.sparse.SparseEfficiencyWarning)
+            self.transitions[self.model.actions[ref-1]][source, label] += 1
+        self.transitions_version += 1
+        return
+    
+    
+    def add_action(self, action):
+        """
+        Adds an empty transition matrix for an action that was not observed
+        before.
+        """
+        if action in self.transitions:
+            return
+        K = self.tree.get_number_of_leaves()
+        if self.sparse_transitions:
+            self.transitions[action] = scipy.sparse.csr_matrix((K, K), dtype=int)
+        else:
+            self.transitions[action] = np.zeros((K, K), dtype=int)
+        self.transitions_version += 1
+        return
+    
+    
+    def _insert_refs(self, refs, labels):
+        """
+        Inserts new references (sorted by label) at the end of their leaves' 
+        segments in the contiguous layout.
+        """
+        K = len(self._offsets) - 1
+        self._permutation = np.insert(self._permutation, self._offsets[labels+1], refs)
+        self._offsets[1:] += np.cumsum(np.bincount(labels, minlength=K))
+        return
+    
+    
+    def get_data_refs(self, first_leaf, last_leaf):
+        """
+        Returns the data references of the leaves first_leaf, ..., last_leaf-1
+        as one slice of the contiguous layout (grouped by leaf, no copy).
+        """
+        assert self.contiguous_refs
+        return self._permutation[self._offsets[first_leaf]:self._offsets[last_leaf]]
+    
+    
+    def split_data_refs(self, leaf_index):
+        """
+        Re-partitions the segment of a leaf that was just split into the two
+        new leaves leaf_index and leaf_index+1, according to the new labels.
+        """
+        assert self.contiguous_refs
+        start = self._offsets[leaf_index]
+        stop = self._offsets[leaf_index+1]
+        segment = self._permutation[start:stop]
+        children = self.labels[segment] - leaf_index
+        order = np.argsort(children, kind='mergesort')
+        self._permutation[start:stop] = segment[order]
+        self._offsets = np.insert(self._offsets, leaf_index+1, start + np.count_nonzero(children == 0))
+        return
             
             
     def get_number_of_partitions(self):
@@ -32,7 +240,7 @@ class Partitioning(object):
         Returns the state(s) that the data belongs to according to the current 
         model.
         """
-        return self.tree.classify(data)
+        return self.compiled_tree.classify(data)
     
 
     def get_merged_transition_matrices(self):
@@ -41,40 +249,185 @@ class Partitioning(object):
         """
         
         K = self.tree.get_number_of_leaves()
-        P = np.zeros((K, K), dtype=int)
+        if self.sparse_transitions:
+            P = scipy.sparse.csr_matrix((K, K), dtype=int)
+        else:
+            P = np.zeros((K, K), dtype=int)
         
         for a in self.model.get_known_actions():
-            P += self.transitions[a]
+            P = P + self.transitions[a]
 
         assert np.sum(P) == self.model.get_number_of_samples() - 1
         return P
 
 
-    def calc_best_split(self):
+    def set_transitions(self, transitions, split_index=None, split_weights=None):
+        """
+        Replaces the transition matrices. If they result from splitting state
+        split_index into split_index and split_index+1, the mass of that state
+        in the cached stationary distributions is divided according to 
+        split_weights, as a start for their re-calculation.
+        """
+        self.transitions = transitions
+        self.transitions_version += 1
+        if split_index is None:
+            self._stationary_distributions = {}
+            return
+        weights = np.array(split_weights, dtype=np.float64)
+        weights = weights / np.sum(weights) if np.sum(weights) > 0 else np.ones(2) / 2.
+        for action, (_, mu) in self._stationary_distributions.items():
+            mu = np.insert(mu, split_index+1, mu[split_index] * weights[1])
+            mu[split_index] *= weights[0]
+            self._stationary_distributions[action] = (None, mu)
+        return
+    
+    
+    def get_stationary_distribution(self, action=None):
+        """
+        Returns the stationary distribution for the transitions of an action
+        (or of all actions for None). It is cached until the transitions 
+        change and then re-calculated starting from the previous one. The 
+        cached array is returned read-only.
+        """
+        version, mu = self._stationary_distributions.get(action, (None, None))
+        if version == self.transitions_version:
+            return mu
+        if action is None:
+            P = self.get_merged_transition_matrices()
+        else:
+            P = self.transitions[action]
+        mu = entropy_utils.stationary_distribution(P, mu0=mu)
+        mu.flags.writeable = False
+        self._stationary_distributions[action] = (self.transitions_version, mu)
+        return mu
+    
+    
+    def get_mutual_information(self, action=None):
+        """
+        Returns the mutual information between successive states for the 
+        transitions of an action (or of all actions for None).
+        """
+        if action is None:
+            P = self.get_merged_transition_matrices()
+        else:
+            P = self.transitions[action]
+        return entropy_utils.mutual_information(P, mu=self.get_stationary_distribution(action))
+
+
+    def calc_best_split(self, processes=None):
         """
         Calculates the gain for each state and returns a split-object for the
-        best one
+        best one. Only leaves with new data since the last call are evaluated,
+        the best split is then taken from a heap. With processes > 1 (by 
+        default the model's split_processes), they are evaluated in the 
+        model's pool of worker processes.
         """
         
         if self.model.data is None:
             return None
-                
-        best_split = None
+        
+        # leaves with new data
+        leaves = [leaf for leaf in self._changed_leaves if leaf.is_leaf()]
+        self._changed_leaves = set()
+        
+        if processes is None:
+            processes = self.model.split_processes
+        if processes > 1:
+            self._calc_split_params_in_parallel(leaves)
 
-        for leaf in self.tree.get_leaves():
+        for leaf in leaves:
             
             if leaf._cached_split_params is None:
                 leaf._cached_split_params = split_params.SplitParamsLocalGain(node=leaf)
                 
             split = leaf._cached_split_params
             split.update()
+            self._push_split(leaf, split)
+            
+        # best valid candidate
+        while self._split_heap:
+            entry = self._split_heap[0]
+            leaf = entry[3]
+            if leaf.is_leaf() and self._split_heap_entries.get(leaf) is entry:
+                return entry[4]
+            heapq.heappop(self._split_heap)
+            if self._split_heap_entries.get(leaf) is entry:
+                del self._split_heap_entries[leaf]
                 
-            # TODO: find a way to mark split as invalid (for instance test_params failed)
-            if split is not None:
-                if best_split is None or split.get_gain() >= best_split.get_gain():
-                    best_split = split
-                
-        return best_split
+        return None
+
+
+    def _push_split(self, leaf, split):
+        """
+        Pushes the split of a leaf onto the heap unless it is there already 
+        with the same gain. Older entries of the leaf become invalid and are 
+        discarded lazily.
+        """
+        
+        gain = split.get_gain()
+        entry = self._split_heap_entries.get(leaf)
+        if entry is not None and entry[4] is split and entry[0] == -gain:
+            return
+        
+        # ties are broken in favor of the right-most leaf. since the order of
+        # leaves never changes, the path from the root is a fixed key for that
+        # (nodes are identified by their list of children because parents 
+        # are weakref proxies)
+        position = []
+        node = leaf
+        while node._parent is not None:
+            siblings = node._parent._children
+            position.append(-[sibling._children is node._children for sibling in siblings].index(True))
+            node = node._parent
+        position.reverse()
+        
+        self._split_heap_counter += 1
+        entry = (-gain, tuple(position), self._split_heap_counter, leaf, split)
+        heapq.heappush(self._split_heap, entry)
+        self._split_heap_entries[leaf] = entry
+        return
+
+
+    def _get_stale_leaves(self, leaves=None):
+        """
+        Returns the leaves (by default the ones with new data) that have no 
+        or stale split parameters.
+        """
+        if leaves is None:
+            leaves = [leaf for leaf in self._changed_leaves if leaf.is_leaf()]
+        return [leaf for leaf in leaves if leaf._cached_split_params is None or leaf._cached_split_params.is_stale()]
+
+
+    def _calc_split_params_in_parallel(self, leaves):
+        """
+        Calculates split parameters for all leaves that have none or stale 
+        ones in the model's pool of worker processes.
+        """
+        
+        stale = self._get_stale_leaves(leaves)
+        if len(stale) < 2:
+            return
+        
+        results = self.model.get_split_pool().imap([(self.active_action, leaf.get_leaf_index()) for leaf in stale])
+        for leaf, result in zip(stale, results):
+            self._import_split_params(leaf, *result)
+        return
+
+
+    def _import_split_params(self, leaf, test_params, gain, number_of_transitions, transitions):
+        """
+        Caches split parameters for the leaf that were calculated in a worker
+        process. The number of transitions they were calculated for is kept 
+        as reference for their staleness, the classification of the 
+        transitions is kept for applying the split.
+        """
+        if test_params is not None:
+            test_params = leaf.TestParams(*test_params)
+        split = split_params.SplitParamsLocalGain(node=leaf, test_params=test_params, gain=gain)
+        split._number_of_transitions = number_of_transitions
+        split._transition_refs, split._transition_refs_1, split._transition_children = transitions
+        leaf._cached_split_params = split
+        return
 
 
     def plot_data_colored_for_state(self, show_plot=True):
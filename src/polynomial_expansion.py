@@ -0,0 +1,98 @@
+import numpy as np
+
+
+# index tables for every (input dimension, degree)
+_tables = {}
+
+
+def _number_of_monomials(degree, dim):
+    """
+    Number of monomials of the given degree in dim variables.
+    """
+    result = 1
+    for i in range(degree):
+        result = result * (dim + i) // (i + 1)
+    return result
+
+
+def _get_tables(dim, degree):
+    """
+    Returns a list with a pair of index arrays for every degree > 1: the
+    variable and the monomial of the previous degree that are multiplied for
+    each output column. Monomials are ordered like in mdp's
+    PolynomialExpansionNode.
+    """
+
+    key = (dim, degree)
+    if key in _tables:
+        return _tables[key]
+
+    tables = []
+    prec_end = 0
+    next_lens = np.ones(dim+1, dtype=int)
+    next_lens[0] = 0
+    for i in range(2, degree+1):
+        prec_start = prec_end
+        prec_end += _number_of_monomials(i-1, dim)
+        lens = next_lens[:-1].cumsum()
+        next_lens = np.zeros(dim+1, dtype=int)
+        variables = []
+        factors = []
+        for j in range(dim):
+            factor_indices = np.arange(prec_start + lens[j], prec_end)
+            variables.append(np.ones(len(factor_indices), dtype=int) * j)
+            factors.append(factor_indices)
+            next_lens[j+1] = len(factor_indices)
+        tables.append((np.hstack(variables), np.hstack(factors)))
+
+    _tables[key] = tables
+    return tables
+
+
+
+class PolynomialExpansion(object):
+    """
+    Expands rows of data into all monomials up to the given degree, the same
+    way as mdp.nodes.PolynomialExpansionNode (and with identical results).
+    Each degree is computed by one vectorized product with the monomials of
+    the previous degree, using index tables that are calculated once per
+    input dimension and degree. With dtype given (e.g., np.float32), the
+    data is converted first.
+    """
+
+    def __init__(self, degree, dtype=None):
+        self.degree = degree
+        self.dtype = dtype
+        return
+
+
+    def get_output_dim(self, dim):
+        return sum([_number_of_monomials(i, dim) for i in range(1, self.degree+1)])
+
+
+    def execute(self, x):
+        """
+        Returns the expansion of every row of x.
+        """
+
+        x = np.array(x, ndmin=2, dtype=self.dtype, copy=False)
+        if x.dtype.kind != 'f':
+            x = np.asarray(x, dtype=np.float64)
+        N, D = x.shape
+
+        # (transposed) monomials of degree 1
+        result = np.empty((self.get_output_dim(D), N), dtype=x.dtype)
+        result[:D] = x.T
+
+        # all following degrees
+        k = D
+        for variables, factors in _get_tables(D, self.degree):
+            result[k:k+len(factors)] = x.T[variables] * result[factors]
+            k += len(factors)
+
+        return result.T
+
+
+
+if __name__ == '__main__':
+    pass
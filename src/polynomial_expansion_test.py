@@ -0,0 +1,36 @@
+import mdp
+import numpy as np
+import unittest
+
+import polynomial_expansion
+
+
+class Test(unittest.TestCase):
+
+
+    def testMdpExpansion(self):
+        # same results as mdp's expansion node
+        for dim in [1, 2, 3]:
+            for degree in [1, 2, 5]:
+                x = np.random.randn(100, dim)
+                y_1 = mdp.nodes.PolynomialExpansionNode(degree=degree).execute(x)
+                y_2 = polynomial_expansion.PolynomialExpansion(degree=degree).execute(x)
+                self.failUnless(np.array_equal(y_1, y_2))
+        return
+    
+    
+    def testDtype(self):
+        # single rows and single precision
+        x = np.random.randn(10, 2)
+        expansion = polynomial_expansion.PolynomialExpansion(degree=3, dtype=np.float32)
+        y = expansion.execute(x)
+        self.failUnless(y.dtype == np.float32)
+        self.failUnless(y.shape == (10, expansion.get_output_dim(2)))
+        self.failUnless(np.allclose(expansion.execute(x[0]), y[0]))
+        self.failUnless(polynomial_expansion.PolynomialExpansion(degree=3).execute(np.arange(2)).dtype == np.float64)
+        return
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -253,7 +253,7 @@ class RLExploration(object):
             new_maze_state, action, _ = self.model_extern.do_action(action=selected_action)
                 
             # inform models about the transition
-            self.world_model.add_data(new_maze_state, actions=[action])
+            self.world_model.add_sample(new_maze_state, action)
             t = self.world_model.classify(new_maze_state)
             r = self.model_intern.set_state(new_state=t, action=action)
             
@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse
 import weakref
 
 import entropy_utils
@@ -6,13 +7,22 @@ import entropy_utils
 
 class SplitParamsLocalGain(object):
     
-    def __init__(self, node):
+    def __init__(self, node, test_params=None, gain=None):
+        """
+        Test parameters and gain are calculated for the node unless they are
+        given (e.g., because they were calculated by a worker process).
+        """
         self._node = self._get_weakref_proxy(node)
         self._model = self._get_weakref_proxy(node.model)
         self._partitioning = self._get_weakref_proxy(node._partitioning)
         self._active_action = node._active_action
-        self._test_params = node._calc_test_params(active_action=self._active_action)
-        self._gain = None
+        self._number_of_samples_when_updated = node.get_number_of_samples()
+        self._number_of_transitions = len(node.get_transition_refs(heading_in=False, inside=True, heading_out=False))
+        if test_params is None:
+            with self._model.profiler.phase('calc_test_params', node, self._number_of_transitions):
+                test_params = node._calc_test_params(active_action=self._active_action)
+        self._test_params = test_params
+        self._gain = gain
         self._new_labels = None
         self._new_data_refs = None
         self._new_trans = None
@@ -21,7 +31,6 @@ class SplitParamsLocalGain(object):
         self._transition_refs_1 = None
         self._non_transition_children = None
         self._non_transition_refs = None
-        self._number_of_samples_when_updated = 0 
         return
     
     
@@ -48,28 +57,23 @@ class SplitParamsLocalGain(object):
         
         # some useful variables
         data = self._node.model.data
-        test_function = self._node._test
         test_params = self._test_params
         assert self._node.is_leaf()
 
-        # create a vectorized test-function
-        t = lambda r: test_function(data[r], params=test_params)
-        t = np.vectorize(t, otypes=[np.int])
-
         # every entry of that node has to be classified...
         refs_1 = self._node.get_transition_refs(heading_in=False, inside=True, heading_out=False)
         refs_2 = refs_1 + 1
         refs = np.union1d(refs_1, refs_2)
         
         if len(refs) > 0:
-            self._transition_children = t(refs)
+            with self._model.profiler.phase('classify_transitions', self._node, len(refs)):
+                self._transition_children = self._node._test_batch(data[refs], params=test_params)
         else:
             self._transition_children = np.empty(0, dtype=int)
         
         # store references for later
         self._transition_refs = refs
         self._transition_refs_1 = refs_1
-        self._number_of_samples_when_updated = self._node.get_number_of_samples()
         return
         
         
@@ -83,20 +87,16 @@ class SplitParamsLocalGain(object):
         
         # some useful variables
         data = self._node.model.data
-        test_function = self._node._test
         test_params = self._test_params
         assert self._node.is_leaf()
 
-        # create a vectorized test-function
-        t = lambda r: test_function(data[r], params=test_params)
-        t = np.vectorize(t, otypes=[np.int])
-
         # calculate indices for non-transition references
         all_refs = self._node.get_data_refs()
         transition_refs = self._transition_refs
         if len(transition_refs) < len(all_refs):
             self._non_transition_refs = np.setdiff1d(all_refs, transition_refs, assume_unique=False)
-            self._non_transition_children = t(self._non_transition_refs)
+            with self._model.profiler.phase('classify_non_transitions', self._node, len(self._non_transition_refs)):
+                self._non_transition_children = self._node._test_batch(data[self._non_transition_refs], params=test_params)
         else:
             self._non_transition_refs = np.empty(0, dtype=int)
             self._non_transition_children = np.empty(0, dtype=int)
@@ -105,52 +105,47 @@ class SplitParamsLocalGain(object):
         return
         
         
+    def is_stale(self):
+        """
+        Returns True if there are new transitions inside the node since the
+        test parameters were calculated - more than the model's 
+        staleness_tolerance (as fraction of the previous number).
+        """
+        number_of_transitions = len(self._node.get_transition_refs(heading_in=False, inside=True, heading_out=False))
+        new_transitions = number_of_transitions - self._number_of_transitions
+        return new_transitions > 0 and new_transitions > self._model.staleness_tolerance * self._number_of_transitions
+    
+    
     def update(self):
         """
-        In case of new transitions inside the node, those are classified
+        In case of new transitions inside the node, the test parameters are
+        re-calculated and the gain is reset. Transitions are (re-)classified
+        lazily with the new parameters the next time the gain is requested.
         """
         
         # new samples?
         if self._number_of_samples_when_updated == self._node.get_number_of_samples():
             return
+        self._number_of_samples_when_updated = self._node.get_number_of_samples()
             
         # new transitions?
-        current_transitions_refs_1 = self._node.get_transition_refs(heading_in=False, inside=True, heading_out=False)
-        if self._transition_refs_1 is None or len(current_transitions_refs_1) == len(self._transition_refs_1):
+        if not self.is_stale():
             return
         
         # new transitions! also update test parameters
-        self._test_params = self._node._calc_test_params(active_action=self._active_action)
-        
-        # calculate new transitions
-        current_transitions_refs_2 = current_transitions_refs_1 + 1
-        current_transitions_refs = np.union1d(current_transitions_refs_1, current_transitions_refs_2)
-        new_transition_refs = np.setdiff1d(current_transitions_refs, self._transition_refs, assume_unique=True)
-
-        # create a vectorized test-function
-        data = self._model.data
-        test_function = self._node._test
-        test_params = self._test_params
-        t = lambda r: test_function(data[r], params=test_params)
-        t = np.vectorize(t, otypes=[np.int])
-        
-        # classify new references
-        new_transition_children = t(new_transition_refs)
-        
-        # store results
-        self._transition_refs = current_transitions_refs
-        self._transition_refs_1 = current_transitions_refs_1
-        self._transition_children = np.hstack([self._transition_children, new_transition_children])
-        assert len(self._transition_refs) == len(self._transition_children)
+        self._number_of_transitions = len(self._node.get_transition_refs(heading_in=False, inside=True, heading_out=False))
+        with self._model.profiler.phase('calc_test_params', self._node, self._number_of_transitions):
+            self._test_params = self._node._calc_test_params(active_action=self._active_action)
         
         # reset
+        self._transition_refs = None
+        self._transition_refs_1 = None
+        self._transition_children = None
         self._gain = None
-        self._number_of_samples_when_updated = self._node.get_number_of_samples()
-        return False
+        return
     
     
 
-
     #@profile
     def get_gain(self):
         """
@@ -171,34 +166,33 @@ class SplitParamsLocalGain(object):
         if self._test_params is None:
             return 0.0
         
-        self._init_transition_children()
+        with self._model.profiler.phase('get_gain', self._node, self._number_of_transitions):
+            self._init_transition_children()
          
-        # helper variables
-        known_actions = self._model.get_known_actions()
-        refs = self._transition_refs
-        refs_1 = self._transition_refs_1
-        refs_2 = refs_1 + 1
-        indices_1 = self._transition_children[np.in1d(refs, refs_1, assume_unique=True)]
-        indices_2 = self._transition_children[np.in1d(refs, refs_2, assume_unique=True)]
+            # helper variables
+            known_actions = self._model.get_known_actions()
+            action_list = sorted(known_actions)
+            A = len(action_list)
+            refs = self._transition_refs
+            refs_1 = self._transition_refs_1
+            indices_1 = self._transition_children[np.searchsorted(refs, refs_1)]
+            indices_2 = self._transition_children[np.searchsorted(refs, refs_1 + 1)]
+            action_indices = np.searchsorted(action_list, self._model.actions[refs_1])
          
-        # transition matrices
-        matrices = {}
-        for action in known_actions:
-            action_mask = (self._model.actions[refs_1] == action)
-            matrices[action] = np.ones((2, 2)) * self._model.uncertainty_prior
-            matrices[action][0,0] += np.count_nonzero((indices_1 == 0) & (indices_2 == 0) & action_mask)
-            matrices[action][0,1] += np.count_nonzero((indices_1 == 0) & (indices_2 == 1) & action_mask)
-            matrices[action][1,0] += np.count_nonzero((indices_1 == 1) & (indices_2 == 0) & action_mask)
-            matrices[action][1,1] += np.count_nonzero((indices_1 == 1) & (indices_2 == 1) & action_mask)
+            # transition matrices for all actions, counted in one pass
+            codes = (action_indices * 2 + indices_1) * 2 + indices_2
+            matrices = np.bincount(codes, minlength=4*A).reshape((A, 2, 2))
+            matrices = matrices + np.ones((A, 2, 2)) * self._model.uncertainty_prior
              
-        # mutual information
-        mi = entropy_utils.mutual_information(matrices[self._active_action], naive_station_dist=True)
-        if len(known_actions) >= 2:
-            mi_inactive = np.mean([entropy_utils.mutual_information(matrices[action], naive_station_dist=True) for action in known_actions if action is not self._active_action])
-            mi = np.mean([mi, mi_inactive])
+            # mutual information
+            mutual_information = entropy_utils.mutual_information_stack(matrices)
+            mi = mutual_information[action_list.index(self._active_action)]
+            if len(known_actions) >= 2:
+                mi_inactive = np.mean([mutual_information[action_list.index(action)] for action in known_actions if action != self._active_action])
+                mi = np.mean([mi, mi_inactive])
            
-        self._gain = mi  
-        return mi
+            self._gain = mi  
+            return mi
 
 
     def get_new_labels(self):
@@ -207,16 +201,20 @@ class SplitParamsLocalGain(object):
         """
         if self._new_labels is not None:
             return self._new_labels
+        
+        with self._model.profiler.phase('get_new_labels', self._node, self._node.get_number_of_samples()):
+            if self._transition_children is None:
+                self._init_transition_children()
 
-        self._init_non_transition_children()
-        current_state = self._node.get_leaf_index()
-        new_labels = np.array(self._partitioning.labels, dtype=int)
-        new_labels = np.where(new_labels > current_state, new_labels + 1, new_labels)
-        new_labels[self._transition_refs] += self._transition_children
-        new_labels[self._non_transition_refs] += self._non_transition_children
+            self._init_non_transition_children()
+            current_state = self._node.get_leaf_index()
+            new_labels = np.array(self._partitioning.labels, dtype=int)
+            new_labels = np.where(new_labels > current_state, new_labels + 1, new_labels)
+            new_labels[self._transition_refs] += self._transition_children
+            new_labels[self._non_transition_refs] += self._non_transition_children
         
-        self._new_labels = new_labels
-        return new_labels
+            self._new_labels = new_labels
+            return new_labels
     
     
     def get_new_data_refs(self):
@@ -258,61 +256,85 @@ class SplitParamsLocalGain(object):
         if self._new_trans is not None:
             return self._new_trans
          
-        # helper variables
-        new_labels = self.get_new_labels()
-        refs = self._node.get_data_refs()
-        index_1 = self._node.get_leaf_index()
-        index_2 = index_1 + 1
-        number_of_samples = self._model.get_number_of_samples()
-        assert self._node.is_leaf()
- 
-        # result
-        transition_matrices = {}
- 
-        for action in self._model.get_known_actions():
-          
-            # new transition matrix
-            new_trans = np.array(self._partitioning.transitions[action])
-            # split current row and set to zero
-            new_trans[index_1,:] = 0
-            new_trans = np.insert(new_trans, index_1, 0, axis=0)  # new row
-            # split current column and set to zero
-            new_trans[:,index_1] = 0
-            new_trans = np.insert(new_trans, index_1, 0, axis=1)  # new column
- 
-            # transitions from current state to another
-             
-            refs_1 = np.setdiff1d(refs, [number_of_samples-1], assume_unique=True) # remove N-1
+        with self._model.profiler.phase('split_transitions', self._node, self._node.get_number_of_samples()):
+            # helper variables
+            new_labels = self.get_new_labels()
+            refs = self._node.get_data_refs()
+            index_1 = self._node.get_leaf_index()
+            number_of_samples = self._model.get_number_of_samples()
+            K = self._node.get_root().get_number_of_leaves() + 1
+            action_list = sorted(self._model.get_known_actions())
+            A = len(action_list)
+            assert self._node.is_leaf()
+        
+            # transitions from current state to another, counted for all actions
+            refs_1 = refs[refs < number_of_samples-1]
             refs_2 = refs_1 + 1
-         
-            labels_1 = new_labels[refs_1]
-            labels_2 = new_labels[refs_2]
- 
-            mask_actions = self._model.actions[refs_1] == action
-             
-            for i in range(self._node.get_root().get_number_of_leaves()+1):
-                new_trans[index_1, i] = np.count_nonzero((labels_1 == index_1) & (labels_2 == i) & mask_actions) 
-                new_trans[index_2, i] = np.count_nonzero((labels_1 == index_2) & (labels_2 == i) & mask_actions) 
-         
+            actions = np.searchsorted(action_list, self._model.actions[refs_1])
+            codes = (actions * 2 + new_labels[refs_1] - index_1) * K + new_labels[refs_2]
+            rows = np.bincount(codes, minlength=A*2*K).reshape((A, 2, K))
+        
             # transitions into current state
-             
-            refs_2 = np.setdiff1d(refs, [0], assume_unique=True)
+            refs_2 = refs[refs > 0]
             refs_1 = refs_2 - 1
-     
-            labels_1 = new_labels[refs_1]
-            labels_2 = new_labels[refs_2]
+            actions = np.searchsorted(action_list, self._model.actions[refs_1])
+            codes = (actions * 2 + new_labels[refs_2] - index_1) * K + new_labels[refs_1]
+            columns = np.bincount(codes, minlength=A*2*K).reshape((A, 2, K))
  
-            mask_actions = self._model.actions[refs_1] == action
-          
-            for i in range(self._node.get_root().get_number_of_leaves()+1):
-                new_trans[i, index_1] = np.count_nonzero((labels_1 == i) & (labels_2 == index_1) & mask_actions) 
-                new_trans[i, index_2] = np.count_nonzero((labels_1 == i) & (labels_2 == index_2) & mask_actions) 
-         
-            assert np.sum(new_trans) == np.sum(self._partitioning.transitions[action])
-            transition_matrices[action] = new_trans
+            # result
+            transition_matrices = {}
+ 
+            for a, action in enumerate(action_list):
+                trans = self._partitioning.transitions[action]
+                new_trans = self._split_transition_matrix(trans, index=index_1, rows=rows[a], columns=columns[a])
+                assert new_trans.sum() == trans.sum()
+                transition_matrices[action] = new_trans
              
-        self._new_trans = transition_matrices
-        return transition_matrices
+            self._new_trans = transition_matrices
+            return transition_matrices
+    
+    
+    def _split_transition_matrix(self, trans, index, rows, columns):
+        """
+        Returns a new transition matrix where state index is replaced by the 
+        two states index and index+1 with the given rows and columns (2xK 
+        each). Works for dense and sparse matrices.
+        """
+        
+        K = rows.shape[1]
+        i = index
+        
+        if scipy.sparse.issparse(trans):
+            
+            # shift the remaining entries
+            trans = trans.tocoo()
+            mask = (trans.row != i) & (trans.col != i)
+            trans_rows = trans.row[mask]
+            trans_cols = trans.col[mask]
+            trans_rows = trans_rows + (trans_rows > i)
+            trans_cols = trans_cols + (trans_cols > i)
+            
+            # new rows and columns (the 2x2 block is part of the rows)
+            rows_1, rows_2 = np.nonzero(rows)
+            columns_1, columns_2 = np.nonzero(columns)
+            columns_mask = (columns_2 < i) | (columns_2 > i+1)
+            columns_1 = columns_1[columns_mask]
+            columns_2 = columns_2[columns_mask]
+            
+            data = np.hstack([trans.data[mask], rows[rows_1, rows_2], columns[columns_1, columns_2]])
+            row_indices = np.hstack([trans_rows, rows_1 + i, columns_2])
+            column_indices = np.hstack([trans_cols, rows_2, columns_1 + i])
+            return scipy.sparse.csr_matrix((data, (row_indices, column_indices)), shape=(K, K))
+        
+        # dense: everything except state index is copied block-wise
+        new_trans = np.empty((K, K), dtype=trans.dtype)
+        new_trans[:i,:i] = trans[:i,:i]
+        new_trans[:i,i+2:] = trans[:i,i+1:]
+        new_trans[i+2:,:i] = trans[i+1:,:i]
+        new_trans[i+2:,i+2:] = trans[i+1:,i+1:]
+        new_trans[i:i+2,:] = rows
+        new_trans[:,i:i+2] = columns.T
+        return new_trans
 
 
 
@@ -0,0 +1,164 @@
+import multiprocessing
+import os
+import pickle
+import tempfile
+
+import split_params
+
+
+# state of a worker process: its copy of the model, the change log and the
+# number of log entries that are applied to the copy already
+_worker_model = None
+_worker_log = None
+_worker_log_length = 0
+_worker_parent_pool = None
+
+
+def _init_worker(model, log_filename):
+    """
+    Initializes a worker process, which was forked from the model's process
+    and thus shares its data without copying it.
+    """
+
+    global _worker_model, _worker_log, _worker_log_length, _worker_parent_pool
+
+    # a worker forked later (to replace another one) already contains the
+    # changes logged so far. the parent's pool is kept referenced, so that
+    # its copy isn't cleaned up in the worker.
+    _worker_parent_pool = model._split_pool
+    _worker_log = open(log_filename, 'rb')
+    _worker_log_length = 0
+    if _worker_parent_pool is not None:
+        _worker_log.seek(_worker_parent_pool._log_offset)
+        _worker_log_length = _worker_parent_pool._log_length
+    model._split_pool = None
+    _worker_model = model
+    return
+
+
+def _sync_worker(log_length):
+    """
+    Applies the changes of the model that were logged since the last task to
+    the worker's copy.
+    """
+
+    global _worker_log_length
+
+    while _worker_log_length < log_length:
+        entry = pickle.load(_worker_log)
+        if entry[0] == 'add_data':
+            _worker_model.add_data(data=entry[1], actions=entry[2])
+        elif entry[0] == 'add_sample':
+            _worker_model.add_sample(entry[1], action=entry[2])
+        else:
+            _, action, leaf_index, test_params = entry
+            leaf = _worker_model.partitionings[action].tree.get_leaf(leaf_index)
+            split_params.SplitParamsLocalGain(node=leaf, test_params=leaf.TestParams(*test_params)).apply()
+        _worker_log_length += 1
+    return
+
+
+def export_split_params(split):
+    """
+    Returns test parameters and gain of a split as plain tuple and float to
+    keep pickling cheap (and possible), together with the number of
+    transitions the test parameters were calculated for and the
+    classification of these transitions.
+    """
+    test_params = split._test_params
+    if test_params is not None:
+        test_params = tuple(test_params)
+    gain = split.get_gain()
+    return test_params, gain, split._number_of_transitions, (split._transition_refs, split._transition_refs_1, split._transition_children)
+
+
+def _calc_split_params(args):
+    """
+    Calculates test parameters and gain for a leaf in a worker process.
+    """
+    log_length, action, leaf_index = args
+    _sync_worker(log_length)
+    leaf = _worker_model.partitionings[action].tree.get_leaf(leaf_index)
+    split = split_params.SplitParamsLocalGain(node=leaf)
+    return export_split_params(split)
+
+
+
+class SplitPool(object):
+    """
+    A pool of worker processes that calculate split parameters for leaves of
+    a model. The workers are forked from the current process when the pool
+    is created and thus share the model's data without copying it. Later
+    changes (new data and splits) are written to a log file, which the
+    workers replay before their next task. So the pool is kept as long as
+    the model, but every worker repeats the model's work of adding data and
+    applying splits. Changed settings of the model are not seen by the
+    workers.
+    """
+
+    def __init__(self, model, processes):
+        fd, self._log_filename = tempfile.mkstemp(prefix='worldmodel_split_log_')
+        self._log = os.fdopen(fd, 'wb')
+        self._log_length = 0
+        self._log_offset = 0
+        self._pool = multiprocessing.Pool(processes=processes, initializer=_init_worker, initargs=(model, self._log_filename))
+        return
+
+
+    def _log_change(self, *entry):
+        # written immediately, so that a worker forked at any time doesn't
+        # see parts of it
+        pickle.dump(entry, self._log, pickle.HIGHEST_PROTOCOL)
+        self._log.flush()
+        self._log_length += 1
+        self._log_offset = self._log.tell()
+        return
+
+
+    def log_data(self, data, actions):
+        """
+        Logs a call of the model's add_data().
+        """
+        self._log_change('add_data', data, actions)
+        return
+
+
+    def log_sample(self, x, action):
+        """
+        Logs a call of the model's add_sample().
+        """
+        self._log_change('add_sample', x, action)
+        return
+
+
+    def log_split(self, action, leaf_index, test_params):
+        """
+        Logs a split of a leaf in the partitioning of action.
+        """
+        self._log_change('split', action, leaf_index, tuple(test_params))
+        return
+
+
+    def imap(self, leaves):
+        """
+        Calculates the split parameters for a list of (action, leaf index)
+        pairs. Returns an iterator over the results (see
+        export_split_params()) in the same order.
+        """
+        return self._pool.imap(_calc_split_params, [(self._log_length, action, leaf_index) for action, leaf_index in leaves])
+
+
+    def close(self):
+        """
+        Stops the worker processes and removes the log.
+        """
+        self._pool.close()
+        self._pool.join()
+        self._log.close()
+        os.remove(self._log_filename)
+        return
+
+
+
+if __name__ == '__main__':
+    pass
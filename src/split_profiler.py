@@ -0,0 +1,134 @@
+import timeit
+
+
+class _Phase(object):
+    """
+    Context manager that measures one phase and reports it to the profiler.
+    """
+
+    def __init__(self, profiler, name, node, n):
+        self._profiler = profiler
+        self._name = name
+        self._node = node
+        self._n = n
+        self._start = None
+        self._nested_time = 0.
+        return
+
+
+    def __enter__(self):
+        self._profiler._stack.append(self)
+        self._start = timeit.default_timer()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = timeit.default_timer() - self._start
+        stack = self._profiler._stack
+        stack.pop()
+        if stack:
+            stack[-1]._nested_time += elapsed
+        self._profiler._add(self._name, self._node, self._n, elapsed, elapsed - self._nested_time)
+        return False
+
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_phase = _NullPhase()
+
+
+
+class SplitProfiler(object):
+    """
+    Accumulates the number of calls, wall times and sizes of the phases of
+    tree growth (like calculating test parameters or gains) per phase,
+    method and action. The time of a phase excludes the phases nested in it,
+    so that times of different phases add up. Sizes are the number of data
+    references n involved, the number of states K and the input dimension D.
+    """
+
+    def __init__(self):
+        self._stack = []
+        self._entries = {}
+        return
+
+
+    def phase(self, name, node, n):
+        """
+        Returns a context manager that measures a phase working on n data
+        references of the given node.
+        """
+        return _Phase(self, name, node, n)
+
+
+    def _add(self, name, node, n, total_time, time):
+        model = node.model
+        partitioning = node._partitioning
+        key = (name, model._method, partitioning.active_action)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {'calls': 0, 'time': 0., 'total_time': 0., 'n': 0, 'K': 0, 'D': 0}
+        entry['calls'] += 1
+        entry['time'] += time
+        entry['total_time'] += total_time
+        entry['n'] += n
+        entry['K'] += partitioning.compiled_tree.get_number_of_leaves()
+        entry['D'] += model.get_input_dim()
+        return
+
+
+    def get_profile(self):
+        """
+        Returns a list with a dictionary for every phase, method and action:
+        the number of calls, the time spent (without nested phases), the
+        total time and the mean sizes n, K and D.
+        """
+        profile = []
+        for (name, method, action), entry in sorted(self._entries.items()):
+            calls = entry['calls']
+            profile.append({'phase': name,
+                            'method': method,
+                            'action': action,
+                            'calls': calls,
+                            'time': entry['time'],
+                            'total_time': entry['total_time'],
+                            'mean_n': float(entry['n']) / calls,
+                            'mean_K': float(entry['K']) / calls,
+                            'mean_D': float(entry['D']) / calls})
+        return profile
+
+
+    def reset(self):
+        self._entries = {}
+        return
+
+
+
+class NullProfiler(object):
+    """
+    A profiler that does nothing (used when profiling is switched off).
+    """
+
+    def phase(self, name, node, n):
+        return _null_phase
+
+
+    def get_profile(self):
+        return []
+
+
+    def reset(self):
+        return
+
+
+
+if __name__ == '__main__':
+    pass
@@ -7,6 +7,8 @@ class Tree(object):
     def __init__(self):
         self._children = []
         self._parent = None
+        self._leaf_index = 0
+        self._leaves = None     # registry of all leaves (root only, after first split)
         
         
     def is_leaf(self):
@@ -23,6 +25,8 @@ class Tree(object):
         
         
     def get_leaves(self):
+        if self._leaves is not None:
+            return list(self._leaves)
         if len(self._children) == 0:
             return [self]
         else:
@@ -33,6 +37,8 @@ class Tree(object):
         
     
     def get_number_of_leaves(self):
+        if self._leaves is not None:
+            return len(self._leaves)
         return len(self.get_leaves())
     
     
@@ -43,7 +49,21 @@ class Tree(object):
     def get_leaf_index(self):
         if not self.is_leaf():
             return None
-        return self.get_root().get_leaves().index(self)
+        return self._leaf_index
+    
+    
+    def get_leaf_range(self):
+        """
+        Returns the indices of the first leaf of this (sub-) tree and the one 
+        after its last leaf. The leaves of a sub-tree are always consecutive.
+        """
+        first = self
+        while not first.is_leaf():
+            first = first._children[0]
+        last = self
+        while not last.is_leaf():
+            last = last._children[-1]
+        return first.get_leaf_index(), last.get_leaf_index() + 1
     
     
     def get_leaf(self, index):
@@ -51,7 +71,9 @@ class Tree(object):
         Returns the leaf with the given index.
         """
         assert self.get_root() is self
-        return self.get_leaves()[index]
+        if self._leaves is None:
+            return [self][index]
+        return self._leaves[index]
     
     
     def split(self, **kwargs):
@@ -67,6 +89,16 @@ class Tree(object):
         child_2._parent = weakref.proxy(self)
         self._children.append(child_1)
         self._children.append(child_2)
+        
+        # update the leaf registry of the root
+        root = self.get_root()
+        if root._leaves is None:
+            root._leaves = [self]
+        index = self._leaf_index
+        root._leaves[index:index+1] = [child_1, child_2]
+        for i in range(index, len(root._leaves)):
+            root._leaves[i]._leaf_index = i
+        self._leaf_index = None
         return (child_1, child_2)
     
     
@@ -78,6 +78,21 @@ class Test(unittest.TestCase):
         self.failUnless(new_leaf_4.get_root() is tree)
 
         return
+    
+    
+    def testLeafIndices(self):
+        # leaf indices have to follow the order of get_leaves()
+        tree = tree_structure.Tree()
+        for i in range(20):
+            leaves = tree.get_leaves()
+            leaves[(7 * i) % len(leaves)].split()
+            leaves = tree._children[0].get_leaves() + tree._children[1].get_leaves()
+            self.failUnless(tree.get_leaves() == leaves)
+            self.failUnless(tree.get_number_of_leaves() == i + 2)
+            for j, leaf in enumerate(leaves):
+                self.failUnless(leaf.get_leaf_index() == j)
+                self.failUnless(tree.get_leaf(j) is leaf)
+        return
         
             
         
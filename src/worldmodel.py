@@ -1,24 +1,96 @@
 import numpy as np
+import os
 import random
 
 from matplotlib import pyplot
 
-from partitioning import Partitioning
+from growable_array import GrowableArray, MemmapArray
+from lru_cache import LRUCache
+from partitioning import Partitioning, calc_best_splits_in_parallel
 import split_params
+import split_pool
+import split_profiler
 import worldmodel_methods
 
 
+# tree classes of the methods
+tree_classes = {'naive': worldmodel_methods.WorldmodelTrivial,
+                'fast': worldmodel_methods.WorldmodelFast,
+                'predictive': worldmodel_methods.WorldmodelGPFA,
+                'spectral': worldmodel_methods.WorldmodelSpectral}
+
+
 
 class Worldmodel(object):
 
 
-    def __init__(self, method='naive', uncertainty_prior=10, factorization_weight=0.9, seed=None):
+    def __init__(self, method='naive', uncertainty_prior=10, factorization_weight=0.9, seed=None, data_file=None, contiguous_refs=False, sparse_transitions=False, split_processes=1, staleness_tolerance=0., whitening_cache_size=64*2**20, expansion_dtype=np.float64, number_of_neighbors=15, neighbor_search_eps=0., number_of_landmarks=1000, profiling=False):
+        """
+        If data_file is given, observations (and actions, in data_file + 
+        '.actions') are stored in memory-mapped files instead of memory. The
+        files must not exist yet. Their dtype is the one of the first data.
+        
+        With contiguous_refs, the data references of every partitioning are 
+        kept in one array grouped by leaf, so that the references of leaves 
+        and sub-trees are slices. This makes splits and data access cheap 
+        but appending single samples costs O(N).
+        
+        With sparse_transitions, transition matrices are stored as sparse 
+        (CSR) matrices, which allows for many more states.
+        
+        With split_processes > 1, split parameters are calculated in parallel
+        by that many (forked) worker processes: for the partitionings of all 
+        actions at once when splitting them together, otherwise for the 
+        leaves of one partitioning. The workers are kept until 
+        close_split_pool() (see SplitPool).
+        
+        The split parameters of a leaf are re-calculated when the number of 
+        transitions inside of it grew by more than staleness_tolerance (as 
+        fraction of the number at the last calculation).
+        
+        Methods 'fast' and 'predictive' cache whitened data for up to 
+        whitening_cache_size bytes, shared by the partitionings of all actions.
+        Their polynomial expansion is computed with expansion_dtype (e.g., 
+        np.float32 for speed).
+        
+        Method 'predictive' estimates the noise from the number_of_neighbors
+        nearest neighbors of every point. With neighbor_search_eps > 0, they 
+        are searched approximately (the k-th neighbor found is at most 
+        (1 + eps) times farther away than the true one).
+        
+        Method 'spectral' approximates spectral splits from a subsample of 
+        number_of_landmarks transition points per node (more are slower but
+        more accurate, -1 means all). The subsample only depends on seed and
+        the node's data.
+        
+        With profiling, the number of calls, wall times and sizes of the 
+        phases of tree growth are accumulated per phase, method and action 
+        (see get_split_profile()). Phases calculated in worker processes are
+        not included.
+        """
         
         # data storage
-        self.data = None                        # global data storage
-        self.actions = np.empty(0, dtype=int)   # an array of actions
+        self._data_file = data_file
+        self._data = None                           # global data storage
+        if data_file is None:
+            self._actions = GrowableArray(dtype=int)    # an array of actions
+        else:
+            if os.path.exists(data_file):
+                raise IOError('%s exists already' % data_file)
+            self._actions = MemmapArray(filename=data_file + '.actions', dtype=int)
         self.uncertainty_prior = uncertainty_prior
         self.factorization_weight = factorization_weight
+        self.contiguous_refs = contiguous_refs
+        self.sparse_transitions = sparse_transitions
+        self.split_processes = split_processes
+        self._split_pool = None
+        self.staleness_tolerance = staleness_tolerance
+        self.whitening_cache = LRUCache(max_bytes=whitening_cache_size)
+        self.expansion_dtype = expansion_dtype
+        self.number_of_neighbors = number_of_neighbors
+        self.neighbor_search_eps = neighbor_search_eps
+        self.number_of_landmarks = number_of_landmarks
+        self.set_profiling(profiling)
         self.partitionings = {}
         self._action_set = set()
 
@@ -26,22 +98,34 @@ class Worldmodel(object):
         #self.gain_measure = gain_measure
         
         # root node of tree
-        assert method in ['naive', 'fast', 'predictive']
+        assert method in tree_classes
         self._method = method
-        if method == 'naive':
-            self._tree_class = worldmodel_methods.WorldmodelTrivial
-        elif method == 'fast':
-            self._tree_class = worldmodel_methods.WorldmodelFast
-        elif method == 'predictive':
-            self._tree_class = worldmodel_methods.WorldmodelGPFA
-        else:
-            assert False
+        self._tree_class = tree_classes[method]
         
         # random generator
+        self.seed = seed
         self._random = random.Random()
         if seed is not None:
-            self.random.seed(seed)
+            self._random.seed(seed)
         return
+    
+    
+    @property
+    def data(self):
+        """
+        A view of all observations stored so far (or None).
+        """
+        if self._data is None:
+            return None
+        return self._data.get()
+    
+    
+    @property
+    def actions(self):
+        """
+        A view of all actions stored so far.
+        """
+        return self._actions.get()
             
             
     def get_input_dim(self):
@@ -63,6 +147,53 @@ class Worldmodel(object):
     
     def get_partitioning(self, action):
         return self.partitionings[action]
+    
+    
+    def get_split_pool(self):
+        """
+        Returns the pool of split_processes worker processes that calculate
+        split parameters. It is created when needed.
+        """
+        if self._split_pool is None:
+            self._split_pool = split_pool.SplitPool(model=self, processes=self.split_processes)
+        return self._split_pool
+    
+    
+    def close_split_pool(self):
+        """
+        Stops the worker processes of the split pool (if there are any).
+        """
+        if self._split_pool is not None:
+            self._split_pool.close()
+            self._split_pool = None
+        return
+    
+    
+    def set_profiling(self, enabled):
+        """
+        Switches profiling of tree growth on (with an empty profile) or off.
+        """
+        if enabled:
+            self.profiler = split_profiler.SplitProfiler()
+        else:
+            self.profiler = split_profiler.NullProfiler()
+        return
+    
+    
+    def get_split_profile(self):
+        """
+        Returns a list with a dictionary for every phase of tree growth, 
+        method and action: the number of calls, the time spent (without 
+        nested phases), the total time and the mean sizes n (data references),
+        K (states) and D (input dimension). The list is empty if profiling is
+        off.
+        """
+        return self.profiler.get_profile()
+    
+    
+    def reset_split_profile(self):
+        self.profiler.reset()
+        return
 
 
     def classify(self, data, action):
@@ -130,55 +261,74 @@ class Worldmodel(object):
                 # (yet empty).
                 
                 partitioning = self.partitionings[action]
-                K = partitioning.tree.get_number_of_leaves()
                 for action_2 in self._action_set:
-                    if action_2 not in partitioning.transitions.keys():
-                        partitioning.transitions[action_2] = np.zeros((K, K), dtype=int)
+                    partitioning.add_action(action_2)
                         
         # store data in model
         if self.data is None:
-            first_data = 0
-            first_source = 0
-            self.data = data
-            self.actions = np.array(actions, dtype=np.int)
-        else:
-            first_data = n
-            first_source = first_data - 1
-            self.data = np.vstack([self.data, data])
-            self.actions = np.hstack([self.actions, actions])
+            if self._data_file is None:
+                self._data = GrowableArray(dtype=data.dtype, shape=data.shape[1:])
+            else:
+                self._data = MemmapArray(filename=self._data_file, dtype=data.dtype, shape=data.shape[1:])
+        self._data.append(data)
+        self._actions.append(np.asarray(actions, dtype=int))
             
         # same number of actions and data points?
         assert self.data.shape[0] == len(self.actions) + 1
         
-        # calculate new labels, and append
+        # calculate new labels, and append (this also updates data references 
+        # and transition matrices)
         for action in self._action_set:
             partitioning = self.partitionings[action]
             new_labels = self.classify(data, action=action)
-            self.partitionings[action].labels = np.hstack([partitioning.labels, new_labels])
-            assert len(self.partitionings[action].labels) == N
-
-        # add references of new data to corresponding partitions            
-        for action in self._action_set:
-            partitioning = self.partitionings[action]
-            leaves = partitioning.tree.get_leaves()
-            for leaf in leaves:
-                leaf_index = leaf.get_leaf_index()
-                new_refs_mask = (new_labels[first_data: N] == leaf_index)
-                new_refs = np.where(new_refs_mask)[0] + first_data
-                leaf.data_refs = np.hstack([leaf.data_refs, new_refs])
-            
-        # update transition matrices
-        # TODO: could be faster
-        for action in self._action_set:
-            partitioning = self.partitionings[action]
-            for i in range(first_source, N-1):
-                source = partitioning.labels[i]
-                target = partitioning.labels[i+1]
-                action_2 = self.actions[i]
-                partitioning.transitions[action_2][source, target] += 1
+            partitioning.add_labels(new_labels)
+            assert len(partitioning.labels) == N
             
         for action in self._action_set:
             assert np.sum(self.partitionings[action].get_merged_transition_matrices()) == N-1
+            
+        # workers of the split pool repeat the change. they can't append to 
+        # memory-mapped files though, they are forked again instead.
+        if self._split_pool is not None:
+            if self._data_file is None:
+                self._split_pool.log_data(data, actions)
+            else:
+                self.close_split_pool()
+        return
+    
+    
+    def add_sample(self, x, action):
+        """
+        Adds a single observation that followed the previous one by the given
+        action. This is a fast path for online learning: every partitioning 
+        classifies x once, and only one data reference and one transition 
+        count are added. The first sample (whose action is ignored as there is
+        no previous observation) and unknown actions are passed on to 
+        add_data().
+        """
+        
+        if self.data is None:
+            self.add_data(x)
+            return
+        
+        if action not in self._action_set:
+            self.add_data(x, actions=[action])
+            return
+        
+        x = np.atleast_2d(x)
+        assert x.shape[0] == 1
+        self._data.append(x)
+        self._actions.append([action])
+        
+        for a, partitioning in self.partitionings.items():
+            label = self.classify(x, action=a)[0]
+            partitioning.add_label(label)
+            
+        if self._split_pool is not None:
+            if self._data_file is None:
+                self._split_pool.log_sample(x, action)
+            else:
+                self.close_split_pool()
         return
     
     
@@ -197,11 +347,23 @@ class Worldmodel(object):
         else:
             actions = [action]
             
+        # grow partitionings of different actions in parallel
+        if self.split_processes > 1 and len(actions) > 1:
+            best_splits = calc_best_splits_in_parallel(model=self, actions=actions)
+        else:
+            best_splits = {}
+            for a in actions:
+                partitioning = self.partitionings[a]
+                with self.profiler.phase('calc_best_split', partitioning.tree, self.get_number_of_samples()):
+                    best_splits[a] = partitioning.calc_best_split()
+            
         for a in actions:
-            split_params = self.partitionings[a].calc_best_split()
+            split_params = best_splits[a]
             if split_params is not None and split_params.get_gain() >= min_gain:
                 print split_params.get_gain()
-                split_params.apply()
+                node = split_params._node
+                with self.profiler.phase('apply_split', node, node.get_number_of_samples()):
+                    split_params.apply()
                 
         return
 
@@ -0,0 +1,383 @@
+"""
+A compact binary file format for trained Worldmodels. Instead of pickling
+the whole object graph, every partitioning is stored as the flat arrays of
+its compiled tree (children, leaf indices and test parameters), its labels
+and transition counts. The observations can be included optionally.
+
+The file starts with a magic string, the format version and a JSON header
+that describes the model and the location, dtype and shape of every array.
+The arrays follow as raw (64-byte aligned) data, so they can be memory-
+mapped and are only read when they are accessed.
+"""
+
+import json
+import numpy as np
+import scipy.sparse
+import scipy.spatial
+import struct
+
+import compiled_tree
+import polynomial_expansion
+import split_params
+import worldmodel
+
+
+MAGIC = 'WORLDMDL'
+FORMAT_VERSION = 1
+
+_prefix = struct.Struct('<8sIQ')
+_alignment = 64
+
+# test parameters that are KD-trees (stored by their data), for every method
+_kdtree_params = {'spectral': ['tree']}
+
+
+def _align(offset):
+    return (offset + _alignment - 1) // _alignment * _alignment
+
+
+def _encode_test_params(test_params, method, prefix, arrays):
+    """
+    Stores the test parameters of all inner nodes field by field in arrays
+    (scalars as one array, arrays and KD-trees concatenated with offsets,
+    polynomial expansions by their degree). Missing KD-trees (None) are 
+    stored as empty arrays. Returns the description of the fields for the 
+    header.
+    """
+
+    fields = []
+    for i, name in enumerate(test_params[0]._fields):
+        values = [params[i] for params in test_params]
+        field = {'name': name}
+        if name in _kdtree_params.get(method, []):
+            field['kind'] = 'kdtree'
+            trees = [v for v in values if v is not None]
+            empty = np.empty((0,) + (trees[0].data.shape[1:] if trees else ()))
+            values = [empty if v is None else v.data for v in values]
+            arrays[prefix + name] = np.concatenate(values)
+            arrays[prefix + name + '_offsets'] = np.cumsum([0] + [len(v) for v in values])
+        elif isinstance(values[0], polynomial_expansion.PolynomialExpansion):
+            dtypes = set([None if v.dtype is None else np.dtype(v.dtype).str for v in values])
+            assert len(dtypes) == 1
+            field['kind'] = 'expansion'
+            field['dtype'] = dtypes.pop()
+            arrays[prefix + name] = np.array([v.degree for v in values], dtype=int)
+        elif isinstance(values[0], np.ndarray):
+            field['kind'] = 'array'
+            arrays[prefix + name] = np.concatenate(values)
+            arrays[prefix + name + '_offsets'] = np.cumsum([0] + [len(v) for v in values])
+        else:
+            field['kind'] = 'scalar'
+            arrays[prefix + name] = np.array(values)
+        if arrays[prefix + name].dtype.hasobject:
+            raise ValueError('test parameter %s of method %s cannot be saved' % (name, method))
+        fields.append(field)
+    return fields
+
+
+def save(model, filename, include_data=True, info=None):
+    """
+    Saves a model. Without include_data only the actions are stored, not the
+    observations. info may be any (JSON serializable) dictionary that is
+    stored as well, e.g., statistics of an experiment.
+    """
+
+    arrays = {}
+    arrays['actions'] = np.asarray(model.actions, dtype=int)
+    if include_data and model.data is not None:
+        arrays['data'] = model.data
+
+    partitionings = []
+    for p, action in enumerate(sorted(model.get_known_actions())):
+
+        partitioning = model.get_partitioning(action)
+        compiled = partitioning.compiled_tree
+        prefix = 'partitioning_%d/' % p
+        arrays[prefix + 'children'] = compiled.children
+        arrays[prefix + 'leaf_ids'] = compiled.leaf_ids
+        arrays[prefix + 'labels'] = partitioning.labels
+
+        # test parameters of inner nodes
+        inner_nodes = np.nonzero(compiled.leaf_ids < 0)[0]
+        arrays[prefix + 'inner_nodes'] = inner_nodes
+        fields = None
+        if len(inner_nodes) > 0:
+            test_params = [compiled.test_params[i] for i in inner_nodes]
+            fields = _encode_test_params(test_params, method=model._method, prefix=prefix + 'test_params/', arrays=arrays)
+
+        # transition counts (dense or CSR)
+        transitions = []
+        for t, (action_2, trans) in enumerate(sorted(partitioning.transitions.items())):
+            trans_prefix = prefix + 'transitions_%d/' % t
+            if scipy.sparse.issparse(trans):
+                trans = scipy.sparse.csr_matrix(trans)
+                arrays[trans_prefix + 'data'] = trans.data
+                arrays[trans_prefix + 'indices'] = trans.indices
+                arrays[trans_prefix + 'indptr'] = trans.indptr
+                transitions.append({'action': int(action_2), 'prefix': trans_prefix, 'sparse': True, 'shape': list(trans.shape)})
+            else:
+                arrays[trans_prefix + 'data'] = trans
+                transitions.append({'action': int(action_2), 'prefix': trans_prefix, 'sparse': False, 'shape': list(trans.shape)})
+
+        partitionings.append({'action': int(action),
+                              'prefix': prefix,
+                              'number_of_states': int(compiled.get_number_of_leaves()),
+                              'test_params': fields,
+                              'transitions': transitions})
+
+    # layout of the arrays
+    layout = {}
+    offset = 0
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        arrays[name] = array
+        layout[name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        offset = _align(offset + array.nbytes)
+
+    header = {'format_version': FORMAT_VERSION,
+              'method': model._method,
+              'settings': {'seed': None if model.seed is None else int(model.seed),
+                           'uncertainty_prior': model.uncertainty_prior,
+                           'factorization_weight': model.factorization_weight,
+                           'contiguous_refs': model.contiguous_refs,
+                           'sparse_transitions': model.sparse_transitions,
+                           'split_processes': model.split_processes,
+                           'staleness_tolerance': model.staleness_tolerance,
+                           'whitening_cache_size': model.whitening_cache.max_bytes,
+                           'expansion_dtype': np.dtype(model.expansion_dtype).str,
+                           'number_of_neighbors': model.number_of_neighbors,
+                           'neighbor_search_eps': model.neighbor_search_eps,
+                           'number_of_landmarks': model.number_of_landmarks},
+              'number_of_samples': model.get_number_of_samples(),
+              'input_dim': None if model.data is None else model.get_input_dim(),
+              'partitionings': partitionings,
+              'arrays': layout,
+              'info': info}
+    header = json.dumps(header)
+    data_start = _align(_prefix.size + len(header))
+
+    with open(filename, 'wb') as f:
+        f.write(_prefix.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        for name in sorted(arrays):
+            f.seek(data_start + layout[name]['offset'])
+            f.write(arrays[name].tostring())
+    return
+
+
+def load(filename, mmap=True):
+    """
+    Opens a saved model. Only the header is read, arrays are read (or
+    memory-mapped) when they are needed.
+    """
+    return SavedWorldmodel(filename, mmap=mmap)
+
+
+
+class SavedWorldmodel(object):
+    """
+    A model loaded from a file. Meta data, labels, transition counts and
+    classification are available without re-building the model, which can
+    be done with to_worldmodel() if the data was saved.
+    """
+
+    def __init__(self, filename, mmap=True):
+
+        self.filename = filename
+        self.mmap = mmap
+        with open(filename, 'rb') as f:
+            prefix = f.read(_prefix.size)
+            if len(prefix) < _prefix.size:
+                raise ValueError('%s is not a saved worldmodel' % filename)
+            magic, version, header_length = _prefix.unpack(prefix)
+            if magic != MAGIC:
+                raise ValueError('%s is not a saved worldmodel' % filename)
+            if version > FORMAT_VERSION:
+                raise ValueError('%s has format version %d, only versions up to %d are supported' % (filename, version, FORMAT_VERSION))
+            header = json.loads(f.read(header_length))
+
+        self.format_version = version
+        self.method = str(header['method'])
+        self.settings = header['settings']
+        self.info = header['info']
+        self._header = header
+        self._data_start = _align(_prefix.size + header_length)
+        self._arrays = {}
+        self._partitionings = dict([(p['action'], p) for p in header['partitionings']])
+        self._compiled_trees = {}
+        return
+
+
+    def _get_array(self, name):
+        """
+        Returns an array of the file (memory-mapped or read once).
+        """
+
+        if name in self._arrays:
+            return self._arrays[name]
+
+        layout = self._header['arrays'][name]
+        dtype = np.dtype(str(layout['dtype']))
+        shape = tuple(layout['shape'])
+        offset = self._data_start + layout['offset']
+        size = int(np.prod(shape))
+        if size == 0:
+            array = np.empty(shape, dtype=dtype)
+        elif self.mmap:
+            array = np.memmap(self.filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            with open(self.filename, 'rb') as f:
+                f.seek(offset)
+                array = np.fromfile(f, dtype=dtype, count=size).reshape(shape)
+        self._arrays[name] = array
+        return array
+
+
+    @property
+    def data(self):
+        """
+        The observations (or None if they were not saved).
+        """
+        if 'data' not in self._header['arrays']:
+            return None
+        return self._get_array('data')
+
+
+    @property
+    def actions(self):
+        return self._get_array('actions')
+
+
+    def get_number_of_samples(self):
+        return self._header['number_of_samples']
+
+
+    def get_input_dim(self):
+        return self._header['input_dim']
+
+
+    def get_known_actions(self):
+        return set(self._partitionings.keys())
+
+
+    def get_number_of_states(self, action):
+        return self._partitionings[action]['number_of_states']
+
+
+    def get_labels(self, action):
+        """
+        Returns the state of every observation for the partitioning of action.
+        """
+        return self._get_array(self._partitionings[action]['prefix'] + 'labels')
+
+
+    def get_transitions(self, action, action_2):
+        """
+        Returns the transition counts for action_2 in the partitioning of
+        action (dense or sparse, like in the model).
+        """
+        for transitions in self._partitionings[action]['transitions']:
+            if transitions['action'] == action_2:
+                prefix = transitions['prefix']
+                if transitions['sparse']:
+                    arrays = (self._get_array(prefix + 'data'), self._get_array(prefix + 'indices'), self._get_array(prefix + 'indptr'))
+                    return scipy.sparse.csr_matrix(arrays, shape=tuple(transitions['shape']))
+                return self._get_array(prefix + 'data')
+        raise KeyError(action_2)
+
+
+    def get_test_params(self, action):
+        """
+        Returns a list with the test parameters of every node of the
+        partitioning of action (None for leaves).
+        """
+
+        partitioning = self._partitionings[action]
+        prefix = partitioning['prefix']
+        inner_nodes = self._get_array(prefix + 'inner_nodes')
+        test_params = [None] * len(self._get_array(prefix + 'leaf_ids'))
+        if len(inner_nodes) == 0:
+            return test_params
+
+        prefix = prefix + 'test_params/'
+        values = []
+        for field in partitioning['test_params']:
+            name = field['name']
+            array = self._get_array(prefix + name)
+            if field['kind'] == 'scalar':
+                values.append(list(array))
+            elif field['kind'] == 'expansion':
+                dtype = None if field['dtype'] is None else np.dtype(str(field['dtype']))
+                values.append([polynomial_expansion.PolynomialExpansion(degree=int(degree), dtype=dtype) for degree in array])
+            else:
+                offsets = self._get_array(prefix + name + '_offsets')
+                field_values = [np.array(array[offsets[i]:offsets[i+1]]) for i in range(len(inner_nodes))]
+                if field['kind'] == 'kdtree':
+                    field_values = [scipy.spatial.cKDTree(v) if len(v) > 0 else None for v in field_values]
+                values.append(field_values)
+
+        TestParams = worldmodel.tree_classes[self.method].TestParams
+        for i, node in enumerate(inner_nodes):
+            test_params[node] = TestParams(*[v[i] for v in values])
+        return test_params
+
+
+    def get_compiled_tree(self, action):
+        """
+        Returns the compiled tree of the partitioning of action.
+        """
+        if action not in self._compiled_trees:
+            prefix = self._partitionings[action]['prefix']
+            tree_class = worldmodel.tree_classes[self.method]
+            # the tests only depend on the parameters, a bare node will do
+            test_batch = tree_class.__new__(tree_class)._test_batch
+            self._compiled_trees[action] = compiled_tree.CompiledTree.from_arrays(test_batch=test_batch,
+                                                                                  children=self._get_array(prefix + 'children'),
+                                                                                  test_params=self.get_test_params(action),
+                                                                                  leaf_ids=self._get_array(prefix + 'leaf_ids'))
+        return self._compiled_trees[action]
+
+
+    def classify(self, data, action):
+        """
+        Returns the state(s) that the data belongs to for the given action.
+        """
+        return self.get_compiled_tree(action).classify(np.atleast_2d(data))
+
+
+    def to_worldmodel(self, **kwargs):
+        """
+        Re-builds the Worldmodel by adding the saved data and applying the
+        saved splits. Settings of the model can be overridden by kwargs.
+        """
+
+        if self.data is None:
+            raise ValueError('%s does not contain data' % self.filename)
+
+        settings = dict([(str(key), value) for key, value in self.settings.items()])
+        settings['expansion_dtype'] = np.dtype(str(settings['expansion_dtype'])).type
+        settings.update(kwargs)
+        model = worldmodel.Worldmodel(method=self.method, **settings)
+        model.add_data(data=np.array(self.data), actions=np.array(self.actions))
+
+        for action in sorted(self.get_known_actions()):
+            partitioning = model.get_partitioning(action)
+            compiled = self.get_compiled_tree(action)
+            nodes = {0: partitioning.tree}
+            stack = [0]
+            while stack:
+                i = stack.pop()
+                if compiled.leaf_ids[i] >= 0:
+                    continue
+                node = nodes[i]
+                split_params.SplitParamsLocalGain(node=node, test_params=compiled.test_params[i]).apply()
+                for j, child in zip(compiled.children[i], node._children):
+                    nodes[j] = child
+                    stack.append(j)
+            assert np.array_equal(partitioning.labels, self.get_labels(action))
+        return model
+
+
+
+if __name__ == '__main__':
+    pass
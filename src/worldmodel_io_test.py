@@ -0,0 +1,120 @@
+import numpy as np
+import os
+import scipy.sparse
+import shutil
+import tempfile
+import unittest
+
+import split_params
+import worldmodel
+import worldmodel_io
+
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'model.wm')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def _create_model(self, method, number_of_actions=2, **kwargs):
+        # fixed data ('fast' may fail numerically for unlucky data)
+        np.random.seed(1)
+        N = 500
+        model = worldmodel.Worldmodel(method=method, seed=0, **kwargs)
+        model.add_data(data=np.random.random((N, 2)), actions=np.random.randint(number_of_actions, size=N-1))
+        for i in range(2):
+            model.split()
+        return model
+
+
+    def _check(self, model, saved):
+        self.failUnless(saved.method == model._method)
+        self.failUnless(saved.get_known_actions() == model.get_known_actions())
+        self.failUnless(saved.get_number_of_samples() == model.get_number_of_samples())
+        self.failUnless(np.array_equal(saved.actions, model.actions))
+        test_data = np.random.random((100, 2))
+        for action in model.get_known_actions():
+            partitioning = model.get_partitioning(action)
+            self.failUnless(saved.get_number_of_states(action) == partitioning.get_number_of_partitions())
+            self.failUnless(np.array_equal(saved.get_labels(action), partitioning.labels))
+            for action_2, trans in partitioning.transitions.items():
+                saved_trans = saved.get_transitions(action, action_2)
+                self.failUnless(scipy.sparse.issparse(saved_trans) == scipy.sparse.issparse(trans))
+                if scipy.sparse.issparse(trans):
+                    trans, saved_trans = trans.toarray(), saved_trans.toarray()
+                self.failUnless(np.array_equal(saved_trans, trans))
+            self.failUnless(np.array_equal(saved.classify(test_data, action=action), model.classify(test_data, action=action)))
+
+
+    def testMethods(self):
+        # saved models classify like the original and can be re-built
+        for method, number_of_actions in [('naive', 2), ('fast', 2), ('predictive', 1), ('spectral', 2)]:
+            model = self._create_model(method=method, number_of_actions=number_of_actions, number_of_landmarks=50)
+            worldmodel_io.save(model, self.filename, info={'method': method})
+            for mmap in [True, False]:
+                saved = worldmodel_io.load(self.filename, mmap=mmap)
+                self.failUnless(saved.info == {'method': method})
+                self.failUnless(np.array_equal(saved.data, model.data))
+                self._check(model, saved)
+            model_2 = saved.to_worldmodel()
+            self._check(model_2, saved)
+            model.split()
+            model_2.split()
+            for action in model.get_known_actions():
+                self.failUnless(np.array_equal(model.get_partitioning(action).labels, model_2.get_partitioning(action).labels))
+        return
+
+
+    def testEmptyLandmarks(self):
+        # splits of leaves without transitions have no landmarks
+        model = self._create_model(method='spectral', number_of_landmarks=50)
+        leaf = model.get_partitioning(0).tree.get_leaves()[0]
+        split_params.SplitParamsLocalGain(node=leaf, test_params=leaf.TestParams(tree=None, u=np.ones(0), k=0)).apply()
+        worldmodel_io.save(model, self.filename)
+        saved = worldmodel_io.load(self.filename)
+        self._check(model, saved)
+        self._check(saved.to_worldmodel(), saved)
+
+        # ... also when no split has landmarks (and with a numpy seed)
+        N = 100
+        model = worldmodel.Worldmodel(method='spectral', seed=np.int32(0))
+        model.add_data(data=np.random.random((N, 2)), actions=np.random.randint(2, size=N-1))
+        for i in range(2):
+            leaf = model.get_partitioning(0).tree.get_leaves()[0]
+            split_params.SplitParamsLocalGain(node=leaf, test_params=leaf.TestParams(tree=None, u=np.ones(0), k=0)).apply()
+        worldmodel_io.save(model, self.filename)
+        saved = worldmodel_io.load(self.filename)
+        self.failUnless(saved.settings['seed'] == 0)
+        self.failIf(any([np.dtype(str(layout['dtype'])).hasobject for layout in saved._header['arrays'].values()]))
+        self.failUnless(all([params is None or params.tree is None for params in saved.get_test_params(0)]))
+        self._check(model, saved)
+        self._check(saved.to_worldmodel(), saved)
+        return
+
+
+    def testWithoutData(self):
+        model = self._create_model(method='naive', sparse_transitions=True)
+        worldmodel_io.save(model, self.filename, include_data=False)
+        saved = worldmodel_io.load(self.filename)
+        self.failUnless(saved.data is None)
+        self._check(model, saved)
+        self.assertRaises(ValueError, saved.to_worldmodel)
+        return
+
+
+    def testInvalidFile(self):
+        with open(self.filename, 'wb') as f:
+            f.write('no model')
+        self.assertRaises(ValueError, worldmodel_io.load, self.filename)
+        return
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,17 +1,63 @@
 import collections
+import hashlib
 import itertools
 import numpy as np
 import scipy.linalg
-import scipy.spatial.distance
+import scipy.sparse
 import scipy.sparse.linalg
+import scipy.spatial
 
 from matplotlib import pyplot
 
 import mdp
 
+import lru_cache
+import polynomial_expansion
+import split_params
 import worldmodel_tree
 
 
+def _calc_whitened_data(node, refs, refs_1, refs_2):
+    """
+    Calculates a polynomial expansion, the mean and whitening matrix W of the
+    expanded data of refs, and the expanded and whitened data of refs_1 and 
+    refs_2. The result does not depend on the action, so it is cached by the
+    model and shared between the partitionings.
+    """
+    
+    model = node.model
+    number_of_actions = len(model.get_known_actions())
+    key = (number_of_actions, model.uncertainty_prior, np.dtype(model.expansion_dtype).str, lru_cache.array_key(refs), lru_cache.array_key(refs_1), lru_cache.array_key(refs_2))
+    result = model.whitening_cache.get(key)
+    if result is not None:
+        return result
+    
+    expansion = polynomial_expansion.PolynomialExpansion(degree=5, dtype=model.expansion_dtype)
+    data = model.get_data_for_refs(refs=refs)
+    data = expansion.execute(data)
+    data_mean = np.mean(data, axis=0)
+    _, D = data.shape
+    
+    # whitening matrix W
+    cov = node._create_covariance_matrix(dim=D)
+    cov.update(data - data_mean)
+    C, _, _ = cov.fix(center=False)
+    E, U = scipy.linalg.eigh(C)
+    W = np.dot(U, np.diag(E**(-.5))).dot(U.T)
+    #W = np.eye(D)
+    
+    # whiten data
+    data_1 = expansion.execute(model.get_data_for_refs(refs=refs_1))
+    data_2 = expansion.execute(model.get_data_for_refs(refs=refs_2))
+    data_whitened_1 = np.dot(data_1 - data_mean, W)
+    data_whitened_2 = np.dot(data_2 - data_mean, W)
+    
+    result = (expansion, data_mean, W, data_whitened_1, data_whitened_2)
+    model.whitening_cache.put(key, result)
+    return result
+    
+    
+
 class WorldmodelTrivial(worldmodel_tree.WorldmodelTree):
     """
     Partitions the feature space into regular (hyper-) cubes.
@@ -27,17 +73,18 @@ class WorldmodelTrivial(worldmodel_tree.WorldmodelTree):
         self._maxima = None    
 
     
-    def _calc_test_params(self, active_action, fast_partition=False):
+    def _init_borders(self):
         """
-        Initializes the parameters that split the node in two halves.
+        Initializes the borders of the node's (hyper-) cube. Borders of parent
+        nodes are initialized as well if necessary, for instance when their
+        test parameters were calculated in another process.
         """
-
-        # init borders
         D = self.model.get_input_dim()
         if self._minima is None:
             if self._parent is not None:
                 # calculate borders from parent
                 parent = self._parent
+                parent._init_borders()
                 self._minima = np.array(parent._minima)
                 self._maxima = np.array(parent._maxima)
                 dim = parent._split_params._test_params[0]
@@ -52,6 +99,16 @@ class WorldmodelTrivial(worldmodel_tree.WorldmodelTree):
                 # top node
                 self._minima = np.zeros(D)
                 self._maxima = np.ones(D) 
+        return
+
+    
+    def _calc_test_params(self, active_action, fast_partition=False):
+        """
+        Initializes the parameters that split the node in two halves.
+        """
+
+        # init borders
+        self._init_borders()
 
         # classifier
         diffs = self._maxima - self._minima
@@ -68,6 +125,13 @@ class WorldmodelTrivial(worldmodel_tree.WorldmodelTree):
             return 1
         return 0
 
+    
+    def _test_batch(self, X, params):
+        """
+        Tests to which child every row of X belongs.
+        """
+        return np.array(X[:,params.dim] > params.cut, dtype=int)
+
 
 
 class WorldmodelFast(worldmodel_tree.WorldmodelTree):
@@ -107,32 +171,14 @@ class WorldmodelFast(worldmodel_tree.WorldmodelTree):
         # helpers
         known_actions = self.model.get_known_actions()
         number_of_actions = len(known_actions)
-        expansion = mdp.nodes.PolynomialExpansionNode(degree=5)
 
         # get transition references (inside this node)        
         trans_refs_1 = self.get_transition_refs(heading_in=False, inside=True, heading_out=True)
         trans_refs_2 = trans_refs_1 + 1
-        data_for_whitening = self.model.get_data_for_refs(refs=trans_refs_1)
-        data_for_whitening = expansion.execute(data_for_whitening)
-        data_mean = np.mean(data_for_whitening, axis=0)
-        _, D = data_for_whitening.shape
-        
-        # whitening matrix W
-        # TODO: cache! it's the same for every action
-        cov = self._create_covariance_matrix(dim=D)
-        cov.update(data_for_whitening - data_mean)
-        C, _, _ = cov.fix(center=False)
-        E, U = scipy.linalg.eigh(C)
-        W = np.dot(U, np.diag(E**(-.5))).dot(U.T)
-        #W = np.eye(D)
         
-        # whiten data
-        data_1 = expansion.execute(self.model.get_data_for_refs(refs=trans_refs_1))
-        data_2 = expansion.execute(self.model.get_data_for_refs(refs=trans_refs_2))
-        data_whitened_1 = np.dot(data_1 - data_mean, W)
-        data_whitened_2 = np.dot(data_2 - data_mean, W)
-        #del data_1
-        #del data_2
+        # whitened data (same for every action)
+        expansion, data_mean, W, data_whitened_1, data_whitened_2 = _calc_whitened_data(node=self, refs=trans_refs_1, refs_1=trans_refs_1, refs_2=trans_refs_2)
+        _, D = data_whitened_1.shape
         
         # filter data for actions
         actions = self.model.actions[trans_refs_1]
@@ -190,6 +236,14 @@ class WorldmodelFast(worldmodel_tree.WorldmodelTree):
         if (y - params.m).dot(params.u) > 0:
             return 1
         return 0
+
+    
+    def _test_batch(self, X, params):
+        """
+        Tests to which child every row of X belongs.
+        """
+        Y = params.expansion.execute(np.array(X, ndmin=2))
+        return np.array((Y - params.m).dot(params.u) > 0, dtype=int)
     
     
     def plot_gradient(self):
@@ -227,38 +281,37 @@ class WorldmodelGPFA(worldmodel_tree.WorldmodelTree):
         return cov
     
     
+    def _get_neighbors(self, data):
+        """
+        Returns the indices of the model's number_of_neighbors nearest 
+        neighbors of every row of data (including the row itself) as n x k 
+        array, with k = 0 for less than two rows. With the model's 
+        neighbor_search_eps > 0, the search is approximate: the k-th neighbor
+        found is at most (1 + eps) times farther away than the true one.
+        """
+        n = len(data)
+        k = min(self.model.number_of_neighbors, n)
+        if k < 2:
+            return np.empty((n, 0), dtype=int)
+        tree = scipy.spatial.cKDTree(data)
+        _, neighbors = tree.query(data, k=k, eps=self.model.neighbor_search_eps)
+        return np.array(neighbors, dtype=int).reshape((n, k))
+    
+    
     def _calc_test_params(self, active_action, fast_partition=False):
 
         # helpers
         known_actions = self.model.get_known_actions()
         number_of_actions = len(known_actions)
-        expansion = mdp.nodes.PolynomialExpansionNode(degree=5)
 
         # get transition references (inside this node)        
         trans_refs_1 = self.get_transition_refs(heading_in=False, inside=True, heading_out=False)
         trans_refs_2 = trans_refs_1 + 1
         trans_refs = np.union1d(trans_refs_1, trans_refs_2)
-        data = self.model.get_data_for_refs(refs=trans_refs)
-        data = expansion.execute(data)
-        data_mean = np.mean(data, axis=0)
-        _, D = data.shape
-        
-        # whitening matrix W
-        # TODO: cache! it's the same for every action
-        cov = self._create_covariance_matrix(dim=D)
-        cov.update(data - data_mean)
-        C, _, _ = cov.fix(center=False)
-        E, U = scipy.linalg.eigh(C)
-        W = np.dot(U, np.diag(E**(-.5))).dot(U.T)
-        #W = np.eye(D)
         
-        # whiten data
-        data_1 = expansion.execute(self.model.get_data_for_refs(refs=trans_refs_1))
-        data_2 = expansion.execute(self.model.get_data_for_refs(refs=trans_refs_2))
-        data_whitened_1 = np.dot(data_1 - data_mean, W)
-        data_whitened_2 = np.dot(data_2 - data_mean, W)
-        #del data_1
-        #del data_2
+        # whitened data (same for every action)
+        expansion, data_mean, W, data_whitened_1, data_whitened_2 = _calc_whitened_data(node=self, refs=trans_refs, refs_1=trans_refs_1, refs_2=trans_refs_2)
+        _, D = data_whitened_1.shape
         
         # filter data for actions
         actions = self.model.actions[trans_refs_1]
@@ -268,21 +321,22 @@ class WorldmodelGPFA(worldmodel_tree.WorldmodelTree):
         data_active_1 = data_whitened_1[indices_active]
         data_active_2 = data_whitened_2[indices_active]
 
-        # pairwise distances of data points
-        distances = scipy.spatial.distance.pdist(data_active_1)
-        distances = scipy.spatial.distance.squareform(distances)
-        neighbors = [np.argsort(distances[i])[0:15] for i in range(len(indices_active))]
+        # nearest neighbors of data points
+        neighbors = self._get_neighbors(data_active_1)
+        n, k = neighbors.shape
 
-        # covariance of future noise
+        # covariance of future noise (from pairs of neighbors, in chunks of 
+        # points to keep memory bounded)
         cov = self._create_covariance_matrix(dim=D)
-        for l in range(len(indices_active)):
-            if len(neighbors[l]) < 2:
-                continue
-            combinations = np.array(list(itertools.combinations(neighbors[l], 2)), dtype=int)
-            indices_i = combinations[:,0]
-            indices_j = combinations[:,1]
-            deltas = data_active_2[indices_i] - data_active_2[indices_j]
-            cov.update(deltas)
+        if k >= 2:
+            combinations = np.array(list(itertools.combinations(range(k), 2)), dtype=int)
+            chunk_size = max(1, 2**20 // (len(combinations) * D))
+            for l in range(0, n, chunk_size):
+                chunk = neighbors[l:l+chunk_size]
+                indices_i = chunk[:,combinations[:,0]].ravel()
+                indices_j = chunk[:,combinations[:,1]].ravel()
+                deltas = data_active_2[indices_i] - data_active_2[indices_j]
+                cov.update(deltas)
         C_final, _, _ = cov.fix()
 
         # inactive covariances as well
@@ -340,6 +394,139 @@ class WorldmodelGPFA(worldmodel_tree.WorldmodelTree):
             return 1
         return 0
 
+    
+    def _test_batch(self, X, params):
+        """
+        Tests to which child every row of X belongs.
+        """
+        Y = params.expansion.execute(np.array(X, ndmin=2))
+        return np.array((Y - params.m).dot(params.u) > 0, dtype=int)
+
+
+
+class WorldmodelSpectral(worldmodel_tree.WorldmodelTree):
+    """
+    Splits a node spectrally: by the second eigenvector of a random walk on a
+    graph of nearest neighbors and transitions. To keep large nodes cheap, 
+    the graph is built on a random subsample of landmarks (model parameter 
+    number_of_landmarks), to which all transitions are assigned. The 
+    eigenvector is extended to all points (Nystroem extension) by averaging 
+    over their nearest landmarks. More landmarks mean better approximation 
+    but higher cost, compare_with_exact_split() reports the difference.
+    """
+    
+    
+    TestParams = collections.namedtuple('TestParams', ['tree', 'u', 'k'])
+    
+    # neighbors per landmark in the graph and for the extension
+    spectral_neighbors = 10
+    
+    
+    def __init__(self, partitioning):
+        super(WorldmodelSpectral, self).__init__(partitioning=partitioning)
+        
+        
+    def _calc_test_params(self, active_action, fast_partition=False, number_of_landmarks=None):
+        """
+        Calculates landmarks and their eigenvector entries. The number of 
+        landmarks defaults to the model's number_of_landmarks, with 
+        number_of_landmarks=-1 every transition point is a landmark, which 
+        gives the exact solution.
+        """
+        
+        if number_of_landmarks is None:
+            number_of_landmarks = self.model.number_of_landmarks
+        
+        # transitions of the active action (or all if there are none)
+        refs_1 = self.get_transition_refs(heading_in=False, inside=True, heading_out=False)
+        active_refs_1 = refs_1[self.model.actions[refs_1] == active_action]
+        if len(active_refs_1) >= 2:
+            refs_1 = active_refs_1
+        refs_2 = refs_1 + 1
+        refs = np.union1d(refs_1, refs_2)
+        n = len(refs)
+        
+        # landmarks (sampled with a generator that depends only on the model's
+        # seed and the node's data, so that the split is the same no matter
+        # in which order or process the nodes are evaluated)
+        m = n if number_of_landmarks < 0 else min(number_of_landmarks, n)
+        if m == 0:
+            return self.TestParams(tree=None, u=np.ones(0), k=0)
+        if m < n:
+            seed = int(hashlib.sha1(repr((self.model.seed, lru_cache.array_key(refs)))).hexdigest()[:8], 16)
+            landmark_refs = refs[np.sort(np.random.RandomState(seed).choice(n, m, replace=False))]
+        else:
+            landmark_refs = refs
+        landmarks = self.model.get_data_for_refs(refs=landmark_refs)
+        tree = scipy.spatial.cKDTree(landmarks)
+        k = min(self.spectral_neighbors, m)
+        if m < 2:
+            return self.TestParams(tree=tree, u=np.ones(m), k=k)
+        
+        # graph of nearest neighbors between landmarks
+        _, neighbors = tree.query(landmarks, k=k+1 if k < m else k)
+        neighbors = np.array(neighbors, dtype=int).reshape((m, -1))
+        rows = np.repeat(np.arange(m), neighbors.shape[1])
+        columns = neighbors.ravel()
+        mask = (rows != columns)
+        W = scipy.sparse.coo_matrix((np.ones(np.count_nonzero(mask)), (rows[mask], columns[mask])), shape=(m, m)).tocsr()
+        W = W + W.T
+        W.data[:] = 1
+        
+        # plus transitions between landmarks (every point is represented by 
+        # its nearest landmark), weighted by landmarks per point
+        if m < n:
+            _, assignments_1 = tree.query(self.model.get_data_for_refs(refs=refs_1))
+            _, assignments_2 = tree.query(self.model.get_data_for_refs(refs=refs_2))
+        else:
+            assignments_1 = np.searchsorted(refs, refs_1)
+            assignments_2 = np.searchsorted(refs, refs_2)
+        C = scipy.sparse.coo_matrix((np.ones(len(refs_1)) * m / n, (assignments_1, assignments_2)), shape=(m, m)).tocsr()
+        W = W + C + C.T
+        
+        # second eigenvector of the random walk D^-1 W from the symmetric 
+        # matrix D^-.5 W D^-.5
+        d = np.array(W.sum(axis=1)).ravel()
+        d_sqrt_inv = 1. / np.sqrt(d)
+        S = scipy.sparse.diags(d_sqrt_inv).dot(W).dot(scipy.sparse.diags(d_sqrt_inv))
+        if m <= 1000:
+            E, V = scipy.linalg.eigh(S.toarray())
+        else:
+            E, V = scipy.sparse.linalg.eigsh(S, k=2, which='LA')
+        u = V[:,np.argsort(E)[-2]] * d_sqrt_inv
+        return self.TestParams(tree=tree, u=u, k=k)
+
+
+    def compare_with_exact_split(self, active_action):
+        """
+        Returns the gain of the approximate split and of the exact one (with 
+        every transition point as landmark). The latter is expensive for 
+        large nodes.
+        """
+        approximate_split = split_params.SplitParamsLocalGain(node=self, test_params=self._calc_test_params(active_action=active_action))
+        exact_split = split_params.SplitParamsLocalGain(node=self, test_params=self._calc_test_params(active_action=active_action, number_of_landmarks=-1))
+        return approximate_split.get_gain(), exact_split.get_gain()
+
+
+    def _test(self, x, params):
+        """
+        Tests to which child the data point x belongs.
+        """
+        return self._test_batch(np.array(x, ndmin=2), params=params)[0]
+
+    
+    def _test_batch(self, X, params):
+        """
+        Tests to which child every row of X belongs: the sign of the mean 
+        eigenvector entry of the nearest landmarks.
+        """
+        X = np.array(X, ndmin=2)
+        if params.k == 0:
+            return np.zeros(len(X), dtype=int)
+        _, neighbors = params.tree.query(X, k=params.k)
+        neighbors = np.array(neighbors, dtype=int).reshape((len(X), params.k))
+        return np.array(np.mean(params.u[neighbors], axis=1) > 0, dtype=int)
+
 
 
 if __name__ == '__main__':
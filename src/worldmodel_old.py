@@ -4,7 +4,9 @@ import matplotlib
 import numpy as np
 import random
 import scipy.linalg
+import scipy.sparse
 import scipy.sparse.linalg
+import scipy.spatial
 import scipy.spatial.distance
 import sklearn.manifold
 import traceback
@@ -27,6 +29,43 @@ SplitResult = collections.namedtuple('SplitResult', ['node',
                                                      'gain',
                                                      'classifier'])
 
+class KNNClassifier(object):
+    """
+    Like mdp.nodes.KNNClassifier (majority of the k nearest samples, ties 
+    resolved to the smaller label) but with neighbors from a KD-tree instead 
+    of a dense distance matrix, so that large data sets can be labeled.
+    """
+    
+    def __init__(self, k=1):
+        self.k = k
+        self._samples = []
+        self._labels = []
+        self.tree = None
+        
+    def train(self, x, labels):
+        self._samples.append(np.array(x, ndmin=2))
+        self._labels.append(np.array(labels, ndmin=1))
+        
+    def stop_training(self):
+        samples = np.vstack(self._samples)
+        labels = np.hstack(self._labels)
+        self.ordered_labels, self.sample_label_indices = np.unique(labels, return_inverse=True)
+        self.tree = scipy.spatial.cKDTree(samples)
+        self._samples = None
+        self._labels = None
+        
+    def label(self, x):
+        x = np.array(x, ndmin=2)
+        k = min(self.k, self.tree.n)
+        _, neighbors = self.tree.query(x, k=k)
+        neighbors = np.array(neighbors, dtype=int).reshape((len(x), k))
+        L = len(self.ordered_labels)
+        votes = self.sample_label_indices[neighbors] + L * np.arange(len(x))[:,np.newaxis]
+        votes = np.bincount(votes.ravel(), minlength=L*len(x)).reshape((len(x), L))
+        return list(self.ordered_labels[np.argmax(votes, axis=1)])
+    
+
+
 class WorldModel(object):
 
     def __init__(self, method='spectral', seed=None):
@@ -2605,143 +2644,125 @@ class WorldModelSpectral(WorldModelTree):
 
 
     def _get_transition_graph(self, action=None, k=10, fast_partition=False, normalize=True):
+        """
+        Returns the sorted references of all transition points, the references
+        of transition starts and the (row-normalized) graph of k nearest 
+        neighbors and transitions as LinearOperator of size n x n. The graph 
+        is stored sparse. Unconnected points are connected with a weight of
+        0.000001, which is added implicitly.
+        """
         assert self.status == 'leaf'
         assert action in self.model.get_possible_actions(ignore_none=False)
         
         # data and references
         [refs_1, refs_2] = self._get_transition_refs_for_action(action=action, heading_in=False, inside=True, heading_out=False)
-        data = self.model._get_data_for_refs(refs_1)
-        refs_all = list(set(refs_1 + refs_2))
+        refs_all = np.union1d(refs_1, refs_2)
         n_trans_all = len(refs_all)
         n_trans = len(refs_1)        
         if n_trans <= 0:
             return [], [], None
+        data = self.model._get_data_for_refs(refs_1)
         
-        # pairwise distances
-        distances = scipy.spatial.distance.pdist(data)
-        distances = scipy.spatial.distance.squareform(distances)
-        
-        # transitions
-        W = np.zeros((n_trans_all, n_trans_all))
-        W += 0.000001
-
-        # big transition matrix
-        # adding transitions to the k nearest neighbors
-        for i in range(n_trans):
-            indices = np.argsort(distances[i])  # closest one should be the point itself
-            # index: refs -> refs_all
-            s = refs_all.index(refs_1[i])
-            for j in indices[0:k+1]:
-                # index: refs -> refs_all
-                t = refs_all.index(refs_1[j])
-                if s != t:
-                    W[s,t] = 1
-                    W[t,s] = 1
-        
-        # big transition matrix
-        # adding transitions of the k nearest neighbors
-        for i in range(n_trans):
-            indices = np.argsort(distances[i])  # closest one should be the point itself
-            # index: refs -> refs_all
-            s = refs_all.index(refs_1[i])
-            for j in indices[0:k+1]:
-                # index: refs -> refs_all
-                t = refs_all.index(refs_1[j])
-                u = refs_all.index(refs_2[j])
-                if s != t:
-                    W[s,t] = 1
-                    W[t,s] = 1
-                if fast_partition:
-                    W[s,u] = -1
-                    W[u,s] = -1
-                else:
-                    W[s,u] = 1
-                    W[u,s] = 1
-
-        # make symmetric        
-        #W = W + W.T
-        #P = W + W.T
-        P = W
+        # nearest neighbors (the closest one should be the point itself)
+        _, neighbors = scipy.spatial.cKDTree(data).query(data, k=min(k+1, n_trans))
+        neighbors = np.array(neighbors, dtype=int).reshape((n_trans, -1))
+        
+        # index: refs -> refs_all
+        rows_1 = np.searchsorted(refs_all, refs_1)
+        rows_2 = np.searchsorted(refs_all, refs_2)
+        s = np.repeat(rows_1, neighbors.shape[1])
+        t = rows_1[neighbors.ravel()]
+        u = rows_2[neighbors.ravel()]
+        
+        # edges to the k nearest neighbors and their successors
+        mask = (s != t)
+        neighbor_edges = scipy.sparse.coo_matrix((np.ones(2*np.count_nonzero(mask)), (np.hstack([s[mask], t[mask]]), np.hstack([t[mask], s[mask]]))), shape=(n_trans_all, n_trans_all)).tocsr()
+        successor_edges = scipy.sparse.coo_matrix((np.ones(2*len(s)), (np.hstack([s, u]), np.hstack([u, s]))), shape=(n_trans_all, n_trans_all)).tocsr()
+        neighbor_edges.data[:] = 1
+        successor_edges.data[:] = 1
+        if fast_partition:
+            W = neighbor_edges - neighbor_edges.multiply(successor_edges) - successor_edges
+        else:
+            W = neighbor_edges + successor_edges
+            W.data[:] = 1
+            
+        # the weight of all other entries (made explicit where W is non-zero)
+        epsilon = 0.000001
+        W = scipy.sparse.csr_matrix(W)
+        W.data -= epsilon
         
         # normalize matrix
+        d = np.ones(n_trans_all)
         if normalize:
-            d = np.sum(P, axis=1)
-            for i in range(n_trans_all):
-                if d[i] > 0:
-                    P[i] = P[i] / d[i]
-            
+            d = np.array(W.sum(axis=1)).ravel() + epsilon * n_trans_all
+            d[d <= 0] = 1
+        
+        def matvec(x):
+            x = np.asarray(x).ravel()
+            return (W.dot(x) + epsilon * np.sum(x)) / d
+        
+        def rmatvec(x):
+            x = np.asarray(x).ravel() / d
+            return W.T.dot(x) + epsilon * np.sum(x)
+        
+        P = scipy.sparse.linalg.LinearOperator(shape=(n_trans_all, n_trans_all), matvec=matvec, rmatvec=rmatvec, dtype=np.float64)
         return refs_all, refs_1, P
 
 
+    @staticmethod
+    def _get_eigenvectors(P):
+        """
+        Returns the stationary distribution pi of the (row-normalized) graph P
+        and the two largest eigenvalues (ascending) with their eigenvectors
+        of (P + Q)/2, where Q = Dinv.dot(P.T.dot(D)) and D = diag(pi).
+        """
+        
+        # stationary distribution (left eigenvector for eigenvalue 1)
+        PT = scipy.sparse.linalg.LinearOperator(shape=P.shape, matvec=P.rmatvec, dtype=np.float64)
+        E, U = scipy.sparse.linalg.eigs(PT, k=1, which='LM', v0=np.ones(P.shape[0]))
+        E, U = (E.real, U.real)
+        np.testing.assert_almost_equal(E[0], 1.)
+        pi = U[:,0]
+        pi /= np.sum(pi)
+        
+        # (P + Q)/2 is self-adjoint w.r.t. pi, so the symmetric version 
+        # S = D^.5 (P + Q)/2 D^-.5 is solved instead
+        sqrt_pi = np.sqrt(pi)
+        def matvec(x):
+            x = np.asarray(x).ravel()
+            y = x / sqrt_pi
+            return sqrt_pi * (P.matvec(y) + P.rmatvec(pi * y) / pi) / 2.
+        S = scipy.sparse.linalg.LinearOperator(shape=P.shape, matvec=matvec, dtype=np.float64)
+        E, V = scipy.sparse.linalg.eigsh(S, k=2, which='LA')
+        idx = np.argsort(E)
+        U = V[:,idx] / sqrt_pi[:,np.newaxis]
+        return pi, E[idx], U
+
+
     def _init_test(self, action, fast_partition=False):
         """
         Initializes the parameters that split the node in two halves.
         """
         assert self.status == 'leaf'
 
-#        for j, k in enumerate([2, 5, 10, 30]):
-
         # data        
         refs_all, refs_1, P = self._get_transition_graph(action=action, k=5, fast_partition=fast_partition, normalize=True)
         if len(refs_1) < self.model._min_class_size:
             return False
         data = self.model._get_data_for_refs(refs=refs_1)
-        n_trans = len(refs_1)
-        
-        # stationary distribution
-        #E, U = scipy.sparse.linalg.eigs(np.array(P.T), k=1, which='LR')
-        E, U = scipy.linalg.eig(a=np.array(P), left=True, right=False)
-        E, U = (E.real, U.real)
-        idx = np.argsort(np.abs(E))
-        np.testing.assert_almost_equal(E[idx[-1]], 1.)
-        pi = U[:,idx[-1]]
-        pi /= np.sum(pi)
-        D = np.diag(pi)
-        Dinv = np.diag(1./pi)
-        
-        # second eigenvector
-        Q = Dinv.dot(P.T.dot(D))
-        #E, U = scipy.sparse.linalg.eigsh((Q + Q.T)/2., M=D, k=2, which='LM')
-        #E, U = scipy.sparse.linalg.eigs((Q + Q.T)/2., M=D, k=2, which='LM')
-        E, U = scipy.linalg.eig(a=(P + Q)/2.)
-        np.testing.assert_almost_equal(np.max(np.abs(E.imag)), 0.)
-        E, U = (E.real, U.real)
-        idx = np.argsort(E)
-        np.testing.assert_almost_equal(E[idx[-1]], 1.)
+        pi, E, U = self._get_eigenvectors(P)
+        np.testing.assert_almost_equal(E[-1], 1.)
         
         # bi-partition
         if fast_partition:
             assert False # we shouldn't be here
-            #idx = np.argsort(abs(E))
-            idx = np.argsort(E)
-            col = idx[-1]
+            col = -1
         else:
-            #idx = np.argsort(E)
-            #idx = np.argsort(np.abs(E))
-            col = idx[-2]
-            #np.testing.assert_almost_equal(E[idx[-1]], 1., decimal=2)
-        u = np.zeros(n_trans)
-        for i in range(n_trans):
-            # index: refs -> refs_all
-            row = refs_all.index(refs_1[i])
-            u[i] = U[row,col].real
-        #u -= np.mean(u)
-            
-#             data += 0.01 * np.random.randn(n_trans, 2)
-#             print E[idx[-1]]
-#             print E[idx[-2]]
-#             print E[idx[-3]]
-#             
-#             colormap = pyplot.cm.get_cmap('summer')
-#             pyplot.subplot(2, 4, j+1)
-#             pyplot.scatter(x=data[:,0], y=data[:,1], c=u, edgecolors='none', vmin=-.05, vmax=.05)
-#             pyplot.subplot(2, 4, j+5)
-#             pyplot.scatter(x=data[:,0], y=data[:,1], c=np.sign(u), cmap=colormap, edgecolors='none')#, vmin=vmin, vmax=vmax)
-#         pyplot.show()
-            
+            col = -2
+        
+        # index: refs -> refs_all
+        u = U[np.searchsorted(refs_all, refs_1), col]
             
-        #assert -1 in np.sign(u)
-        #assert 1 in np.sign(u)
         if -1 not in np.sign(u):
             return False
         if 1 not in np.sign(u):
@@ -2749,7 +2770,7 @@ class WorldModelSpectral(WorldModelTree):
         
         # classifier
         labels = map(lambda x: 1 if x > 0 else 0, u)
-        self.classifier = mdp.nodes.KNNClassifier(k=50)
+        self.classifier = KNNClassifier(k=50)
         #self.classifier = mdp.nodes.NearestMeanClassifier()
         #self.classifier = mdp.nodes.LibSVMClassifier(probability=False)
         self.classifier.train(data, np.array(labels, dtype='int'))
@@ -1,7 +1,10 @@
 import numpy as np
+import scipy.linalg
+import scipy.spatial.distance
 import unittest
 
 import worldmodel
+import worldmodel_old
 from numpy.ma.testutils import assert_almost_equal
 
 
@@ -186,5 +189,82 @@ class VectorEntropyTests(unittest.TestCase):
         assert_almost_equal(1.5, worldmodel.WorldModel._mutual_information_average(transition_matrices=[S, T]))
 
 
+
+class SpectralTests(unittest.TestCase):
+    
+    def setUp(self):
+        np.random.seed(0)
+        self.model = worldmodel_old.WorldModel(method='spectral')
+        self.model.add_data(np.random.random((100, 2)), actions=list(np.random.randint(2, size=99)))
+        
+    def _get_dense_transition_graph(self, node, action, k):
+        """
+        The row-normalized graph of k nearest neighbors and transitions, 
+        built explicitly as dense matrix.
+        """
+        [refs_1, refs_2] = node._get_transition_refs_for_action(action=action, heading_in=False, inside=True, heading_out=False)
+        refs_all = sorted(set(refs_1) | set(refs_2))
+        data = self.model._get_data_for_refs(refs_1)
+        distances = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(data))
+        W = 0.000001 * np.ones((len(refs_all), len(refs_all)))
+        for i in range(len(refs_1)):
+            s = refs_all.index(refs_1[i])
+            for j in np.argsort(distances[i])[:k+1]:
+                t = refs_all.index(refs_1[j])
+                u = refs_all.index(refs_2[j])
+                if s != t:
+                    W[s,t] = W[t,s] = 1
+                W[s,u] = W[u,s] = 1
+        return W / np.sum(W, axis=1)[:,np.newaxis]
+        
+    def testTransitionGraph(self):
+        node = self.model.tree
+        for action in [0, 1]:
+            refs_all, _, P = node._get_transition_graph(action=action, k=5)
+            W = self._get_dense_transition_graph(node, action=action, k=5)
+            I = np.eye(len(refs_all))
+            self.assertTrue(np.allclose(np.array([P.matvec(x) for x in I]).T, W))
+            self.assertTrue(np.allclose(np.array([P.rmatvec(x) for x in I]).T, W.T))
+            
+    def testEigenvectors(self):
+        node = self.model.tree
+        _, _, P = node._get_transition_graph(action=0, k=5)
+        W = self._get_dense_transition_graph(node, action=0, k=5)
+        pi, E, U = worldmodel_old.WorldModelSpectral._get_eigenvectors(P)
+        
+        # stationary distribution
+        E_dense, U_dense = scipy.linalg.eig(a=W, left=True, right=False)
+        pi_dense = U_dense[:,np.argmax(np.abs(E_dense))].real
+        self.assertTrue(np.allclose(pi, pi_dense / np.sum(pi_dense)))
+        
+        # second eigenvector of (P + Q)/2
+        Q = np.diag(1./pi).dot(W.T.dot(np.diag(pi)))
+        E_dense, U_dense = scipy.linalg.eig(a=(W + Q)/2.)
+        idx = np.argsort(E_dense.real)
+        self.assertTrue(np.allclose(E, E_dense.real[idx[-2:]]))
+        u = U[:,0] / np.linalg.norm(U[:,0])
+        u_dense = U_dense[:,idx[-2]].real / np.linalg.norm(U_dense[:,idx[-2]].real)
+        self.assertTrue(np.allclose(u, u_dense) or np.allclose(u, -u_dense))
+        
+    def testKNNClassifier(self):
+        data = np.random.random((200, 2))
+        labels = np.random.choice([2, 5, 7], size=200)
+        test_data = np.random.random((100, 2))
+        k = 4
+        classifier = worldmodel_old.KNNClassifier(k=k)
+        classifier.train(data[:150], labels[:150])
+        classifier.train(data[150:], labels[150:])
+        classifier.stop_training()
+        
+        # majority of the k nearest samples, ties resolved to the smaller label
+        distances = scipy.spatial.distance.cdist(test_data, data)
+        expected = []
+        for i in range(len(test_data)):
+            votes = [np.count_nonzero(labels[np.argsort(distances[i])[:k]] == label) for label in [2, 5, 7]]
+            expected.append([2, 5, 7][np.argmax(votes)])
+        self.assertEqual(classifier.label(test_data), expected)
+        
+
+
 if __name__ == "__main__":
     unittest.main()
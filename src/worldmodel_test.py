@@ -1,6 +1,11 @@
 import numpy as np
+import os
+import scipy.spatial.distance
+import shutil
+import tempfile
 import unittest
 
+import entropy_utils
 import worldmodel
 
 
@@ -61,6 +66,364 @@ class TestRandomData(unittest.TestCase):
             self.failUnless(model.partitionings[a].transitions[-1] == 1)
             
             
+    def testIngest(self):
+        
+        # add data in chunks (with splits in between) and compare data 
+        # references and transitions with labels
+        N = 100
+        for contiguous_refs in [False, True]:
+            model = worldmodel.Worldmodel(method='naive', seed=None, contiguous_refs=contiguous_refs)
+            for i in range(4):
+                data = np.random.random((N, 2))
+                actions = np.random.randint(i+1, size=N-1)
+                model.add_data(data=data, actions=actions)
+                model.add_sample(data[0], action=0)
+                model.split()
+            self._checkIngest(model)
+            
+            # views of the labels don't change with splits
+            labels = model.get_partitioning(0).labels
+            expected_labels = np.array(labels)
+            model.split(action=0)
+            self.failUnless(np.array_equal(labels, expected_labels))
+            
+            
+    def _checkIngest(self, model):
+        for partitioning in model.partitionings.values():
+            labels = partitioning.labels
+            for i, leaf in enumerate(partitioning.tree.get_leaves()):
+                refs = np.where(labels == i)[0]
+                inside_refs = [ref for ref in refs if ref+1 in refs]
+                self.failUnless(np.array_equal(leaf.data_refs, refs))
+                self.failUnless(np.array_equal(leaf.get_transition_refs(), inside_refs))
+            for action in model.get_known_actions():
+                K = partitioning.get_number_of_partitions()
+                P = np.zeros((K, K), dtype=int)
+                for j in np.where(model.actions == action)[0]:
+                    P[labels[j], labels[j+1]] += 1
+                self.failUnless(np.array_equal(partitioning.transitions[action], P))
+            
+            
+    def testAddSample(self):
+        
+        # adding samples one by one has to give the same result as adding 
+        # them all at once
+        N = 100
+        data = np.random.random((2*N, 2))
+        actions = np.random.randint(2, size=2*N-1)
+        model_1 = worldmodel.Worldmodel(method='naive', seed=None)
+        model_2 = worldmodel.Worldmodel(method='naive', seed=None)
+        model_1.add_data(data=data[:N], actions=actions[:N-1])
+        model_2.add_data(data=data[:N], actions=actions[:N-1])
+        model_1.split()
+        model_2.split()
+        model_1.add_data(data=data[N:], actions=actions[N-1:])
+        for i in range(N, 2*N):
+            model_2.add_sample(data[i], action=actions[i-1])
+            
+        self.failUnless(np.array_equal(model_1.data, model_2.data))
+        self.failUnless(np.array_equal(model_1.actions, model_2.actions))
+        for action in model_1.get_known_actions():
+            partitioning_1 = model_1.get_partitioning(action)
+            partitioning_2 = model_2.get_partitioning(action)
+            self.failUnless(np.array_equal(partitioning_1.labels, partitioning_2.labels))
+            for a in model_1.get_known_actions():
+                self.failUnless(np.array_equal(partitioning_1.transitions[a], partitioning_2.transitions[a]))
+            for leaf_1, leaf_2 in zip(partitioning_1.tree.get_leaves(), partitioning_2.tree.get_leaves()):
+                self.failUnless(np.array_equal(leaf_1.data_refs, leaf_2.data_refs))
+                
+        # starting from an empty model
+        model_1 = worldmodel.Worldmodel(method='naive', seed=None)
+        model_2 = worldmodel.Worldmodel(method='naive', seed=None)
+        model_1.add_data(data=data[:N], actions=actions[:N-1])
+        model_2.add_sample(data[0], action=actions[0])
+        for i in range(1, N):
+            model_2.add_sample(data[i], action=actions[i-1])
+        self.failUnless(np.array_equal(model_1.data, model_2.data))
+        self.failUnless(np.array_equal(model_1.actions, model_2.actions))
+        self.failUnless(model_1.get_known_actions() == model_2.get_known_actions())
+        for action in model_1.get_known_actions():
+            for a in model_1.get_known_actions():
+                self.failUnless(np.array_equal(model_1.get_partitioning(action).transitions[a], model_2.get_partitioning(action).transitions[a]))
+            
+            
+    def _assert_equivalent(self, method, settings=None, rounds=3, **options):
+        """
+        Builds two models from the same data, the second one with the given 
+        options, and checks that they give the same partitionings. Returns 
+        both models for further checks.
+        """
+        # fixed data ('fast' may fail numerically for unlucky data)
+        np.random.seed(1)
+        N = 200
+        settings = {} if settings is None else settings
+        model_1 = worldmodel.Worldmodel(method=method, seed=0, **settings)
+        options.update(settings)
+        model_2 = worldmodel.Worldmodel(method=method, seed=0, **options)
+        for i in range(rounds):
+            data = np.random.random((N, 2))
+            actions = np.random.randint(i+2, size=N-1)
+            for model in [model_1, model_2]:
+                model.add_data(data=data, actions=actions)
+                model.add_sample(data[0], action=0)
+                model.split()
+                
+        self.failUnless(np.array_equal(model_1.data, model_2.data))
+        self.failUnless(np.array_equal(model_1.actions, model_2.actions))
+        for action in model_1.get_known_actions():
+            self.failUnless(np.array_equal(model_1.get_partitioning(action).labels, model_2.get_partitioning(action).labels))
+        return model_1, model_2
+            
+            
+    def testContiguousRefs(self):
+        
+        # contiguous layout has to give the same references
+        model_1, model_2 = self._assert_equivalent('naive', contiguous_refs=True)
+        for action in model_1.get_known_actions():
+            tree_1 = model_1.get_partitioning(action).tree
+            tree_2 = model_2.get_partitioning(action).tree
+            for leaf_1, leaf_2 in zip(tree_1.get_leaves(), tree_2.get_leaves()):
+                self.failUnless(np.array_equal(leaf_1.data_refs, leaf_2.data_refs))
+                self.failUnless(np.array_equal(leaf_1.get_data(), leaf_2.get_data()))
+            self.failUnless(np.array_equal(tree_1.get_data_refs(), np.sort(tree_2.get_data_refs())))
+            for child_1, child_2 in zip(tree_1._children, tree_2._children):
+                self.failUnless(np.array_equal(child_1.get_data_refs(), np.sort(child_2.get_data_refs())))
+            
+            
+    def testSparseTransitions(self):
+        
+        # sparse transition matrices have to give the same counts
+        model_1, model_2 = self._assert_equivalent('naive', sparse_transitions=True)
+        for action in model_1.get_known_actions():
+            partitioning_1 = model_1.get_partitioning(action)
+            partitioning_2 = model_2.get_partitioning(action)
+            for a in model_1.get_known_actions():
+                self.failUnless(np.array_equal(partitioning_1.transitions[a], partitioning_2.transitions[a].toarray()))
+            self.failUnless(np.array_equal(partitioning_1.get_merged_transition_matrices(), partitioning_2.get_merged_transition_matrices().toarray()))
+            
+            
+    def testSplitProcesses(self):
+        
+        # splits calculated in worker processes have to be the same
+        for method in ['naive', 'fast', 'spectral']:
+            model_1, model_2 = self._assert_equivalent(method, settings={'number_of_landmarks': 50}, split_processes=3)
+            for model in [model_1, model_2]:
+                model.split(action=1)   # leaves in parallel
+            for action in model_1.get_known_actions():
+                partitioning_1 = model_1.get_partitioning(action)
+                partitioning_2 = model_2.get_partitioning(action)
+                self.failUnless(np.array_equal(partitioning_1.labels, partitioning_2.labels))
+                partitioning_1.calc_best_split()
+                partitioning_2.calc_best_split()
+                for leaf_1, leaf_2 in zip(partitioning_1.tree.get_leaves(), partitioning_2.tree.get_leaves()):
+                    self.failUnless(np.allclose(leaf_1._cached_split_params.get_gain(), leaf_2._cached_split_params.get_gain()))
+                    
+            # the workers are kept until the pool is closed
+            pool = model_2._split_pool
+            model_2.add_sample(model_2.data[0], action=0)
+            model_2.split()
+            self.failUnless(pool is not None and model_2._split_pool is pool)
+            model_2.close_split_pool()
+            self.failUnless(model_2._split_pool is None)
+            
+        # with a staleness tolerance, leaves growing a little every round
+        # must be refreshed at the same time in worker processes
+        model_1, model_2 = self._assert_equivalent('naive', settings={'staleness_tolerance': 0.5}, rounds=8, split_processes=3)
+        for action in model_1.get_known_actions():
+            partitioning_1 = model_1.get_partitioning(action)
+            partitioning_2 = model_2.get_partitioning(action)
+            for leaf_1, leaf_2 in zip(partitioning_1.tree.get_leaves(), partitioning_2.tree.get_leaves()):
+                split_1 = leaf_1._cached_split_params
+                split_2 = leaf_2._cached_split_params
+                self.failUnless((split_1 is None) == (split_2 is None))
+                if split_1 is None:
+                    continue
+                self.failUnless(split_1._number_of_transitions == split_2._number_of_transitions)
+                self.failUnless(np.allclose(split_1.get_gain(), split_2.get_gain()))
+        model_2.close_split_pool()
+            
+            
+    def testBestSplit(self):
+        
+        # best split from the heap has to be the best one of all leaves
+        N = 200
+        model = worldmodel.Worldmodel(method='naive', seed=None)
+        for i in range(5):
+            data = np.random.random((N, 2))
+            actions = np.random.randint(2, size=N-1)
+            model.add_data(data=data, actions=actions)
+            model.split()
+            for action in model.get_known_actions():
+                partitioning = model.get_partitioning(action)
+                best_split = partitioning.calc_best_split()
+                gains = [leaf._cached_split_params.get_gain() for leaf in partitioning.tree.get_leaves()]
+                self.failUnless(best_split.get_gain() == max(gains))
+                
+        # with a large tolerance, new data doesn't change the test parameters
+        model.staleness_tolerance = 1000.
+        partitioning = model.get_partitioning(0)
+        splits = [leaf._cached_split_params for leaf in partitioning.tree.get_leaves()]
+        test_params = [split._test_params for split in splits]
+        model.add_data(data=np.random.random((N, 2)), actions=np.random.randint(2, size=N-1))
+        partitioning.calc_best_split()
+        for split, params in zip(splits, test_params):
+            self.failUnless(split._test_params is params)
+            
+            
+    def testWhiteningCache(self):
+        
+        # cached whitening must not change the splits
+        model_1, model_2 = self._assert_equivalent('fast', whitening_cache_size=0)
+        self.failUnless(model_1.whitening_cache.hits > 0)
+        self.failUnless(len(model_2.whitening_cache) == 0)
+            
+            
+    def testNeighborSearch(self):
+        
+        # exact neighbors are the ones of a brute-force search
+        N = 300
+        data = np.random.random((N, 2))
+        actions = np.random.randint(3, size=N-1)
+        model = worldmodel.Worldmodel(method='predictive', seed=None)
+        model.add_data(data=data, actions=actions)
+        points = np.random.random((50, 3))
+        neighbors = model.get_partitioning(0).tree._get_neighbors(points)
+        distances = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(points))
+        self.failUnless(neighbors.shape == (50, model.number_of_neighbors))
+        for i in range(len(points)):
+            self.failUnless(set(neighbors[i]) == set(np.argsort(distances[i])[:model.number_of_neighbors]))
+        
+        # exact and approximate neighbors give valid splits
+        for eps in [0., 1.]:
+            model = worldmodel.Worldmodel(method='predictive', seed=None, neighbor_search_eps=eps)
+            model.add_data(data=data, actions=actions)
+            model.split(action=0)
+            partitioning = model.get_partitioning(0)
+            self.failUnless(partitioning.tree.get_number_of_leaves() == 2)
+            self.failUnless(np.array_equal(partitioning.labels, model.classify(data, action=0)))
+            
+            
+    def testSpectral(self):
+        
+        # two clusters with rare transitions between them
+        N = 1000
+        clusters = np.cumsum(np.random.random(N) < 0.02) % 2
+        data = np.random.randn(N, 2) * 0.5
+        data[:,0] += 4 * clusters
+        actions = np.zeros(N-1, dtype=int)
+        
+        # approximate and exact split
+        model = worldmodel.Worldmodel(method='spectral', seed=0, number_of_landmarks=100)
+        model.add_data(data=data, actions=actions)
+        approximate_gain, exact_gain = model.get_partitioning(0).tree.compare_with_exact_split(active_action=0)
+        self.failUnless(np.abs(approximate_gain - exact_gain) < 0.1)
+        model.split()
+        labels = model.get_partitioning(0).labels
+        self.failUnless(np.mean(labels == clusters) > .95 or np.mean(labels != clusters) > .95)
+        self.failUnless(np.array_equal(labels, model.classify(data, action=0)))
+        
+        # leaves without transitions (of the active action) can be split 
+        N = 3000
+        model = worldmodel.Worldmodel(method='spectral', seed=0)
+        model.add_data(data=np.random.random((N, 2)), actions=np.random.randint(4, size=N-1))
+        partitioning = model.get_partitioning(0)
+        while min([len(leaf.get_transition_refs()) for leaf in partitioning.tree.get_leaves()]) > 0:
+            self.failUnless(partitioning.tree.get_number_of_leaves() < 50)
+            model.split(action=0)
+        model.split(action=0)
+        self.failUnless(np.array_equal(partitioning.labels, model.classify(model.data, action=0)))
+            
+            
+    def testStationaryDistribution(self):
+        
+        # cached distributions have to be the ones of the current transitions
+        N = 200
+        model = worldmodel.Worldmodel(method='naive', seed=None)
+        for i in range(3):
+            data = np.random.random((N, 2))
+            actions = np.random.randint(2, size=N-1)
+            model.add_data(data=data, actions=actions)
+            partitioning = model.get_partitioning(0)
+            for j in range(3):
+                model.split(action=0)
+                for action in [None, 0, 1]:
+                    P = partitioning.get_merged_transition_matrices() if action is None else partitioning.transitions[action]
+                    mu = entropy_utils._stationary_distribution(P)
+                    self.failUnless(np.allclose(partitioning.get_stationary_distribution(action), mu / np.sum(mu)))
+                    self.failUnless(np.allclose(partitioning.get_mutual_information(action), entropy_utils.mutual_information(P)))
+                    
+        # unchanged transitions aren't calculated again
+        mu = partitioning.get_stationary_distribution()
+        self.failUnless(partitioning.get_stationary_distribution() is mu)
+        
+        # ... and can't be changed by callers
+        self.assertRaises(ValueError, mu.__setitem__, 0, 1.)
+        entropy_utils.entropy_rate(partitioning.get_merged_transition_matrices(), mu=mu)
+        model.add_sample(data[0], action=0)
+        self.failIf(partitioning.get_stationary_distribution() is mu)
+            
+            
+    def testProfiling(self):
+        
+        # profiling doesn't change the model
+        model_1, model_2 = self._assert_equivalent('naive', profiling=True)
+        self.failUnless(model_1.get_split_profile() == [])
+        
+        # every phase is profiled for both actions
+        profile = model_2.get_split_profile()
+        phases = ['calc_best_split', 'calc_test_params', 'classify_transitions', 'get_gain', 'get_new_labels', 'split_transitions', 'apply_split']
+        self.failUnless(set([(p['phase'], p['action']) for p in profile]) >= set([(phase, action) for phase in phases for action in [0, 1]]))
+        for p in profile:
+            self.failUnless(p['method'] == 'naive')
+            self.failUnless(p['calls'] > 0)
+            self.failUnless(0 <= p['time'] <= p['total_time'])
+            self.failUnless(p['mean_D'] == 2)
+        
+        # nested phases are not counted twice
+        calc_best_split = [p for p in profile if p['phase'] == 'calc_best_split' and p['action'] == 0][0]
+        nested = [p for p in profile if p['phase'] in ['calc_test_params', 'get_gain'] and p['action'] == 0]
+        self.failUnless(calc_best_split['time'] < calc_best_split['total_time'] - sum([p['time'] for p in nested]) + 1e-9)
+        
+        # splitting actions in parallel gives the same calls of the phase 
+        _, model_3 = self._assert_equivalent('naive', profiling=True, split_processes=2)
+        model_3.close_split_pool()
+        calls_2 = [(p['action'], p['calls']) for p in profile if p['phase'] == 'calc_best_split']
+        calls_3 = [(p['action'], p['calls']) for p in model_3.get_split_profile() if p['phase'] == 'calc_best_split']
+        self.failUnless(calls_2 == calls_3)
+        
+        # switched off
+        model_2.set_profiling(False)
+        self.failUnless(model_2.get_split_profile() == [])
+            
+            
+    def testDataFile(self):
+        
+        # memory-mapped data has to give the same model
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'data')
+            _, model_2 = self._assert_equivalent('naive', data_file=filename)
+            del model_2
+            
+            # existing files are not overwritten
+            size = os.path.getsize(filename)
+            self.assertRaises(IOError, worldmodel.Worldmodel, method='naive', seed=None, data_file=filename)
+            self.failUnless(os.path.getsize(filename) == size)
+            
+            # in-memory and memory-mapped data keep their dtype
+            N = 200
+            data = np.random.random((N, 2))
+            actions = np.random.randint(2, size=N-1)
+            model_1 = worldmodel.Worldmodel(method='naive', seed=None)
+            model_2 = worldmodel.Worldmodel(method='naive', seed=None, data_file=os.path.join(directory, 'data_float32'))
+            for model in [model_1, model_2]:
+                model.add_data(data=np.array(data, dtype=np.float32), actions=actions)
+                self.failUnless(model.data.dtype == np.float32)
+            del model, model_2
+        finally:
+            shutil.rmtree(directory)
+            
+            
     def testBasics(self):
 
         N = 100
@@ -129,6 +492,44 @@ class TestOrderedData2(unittest.TestCase):
 
 
 
+class TestClassification(unittest.TestCase):
+
+    def testBatchClassification(self):
+        
+        # batch classification has to give the same labels as walking down 
+        # the tree row by row
+        N = 500
+        for method in ['naive', 'fast']:
+            data = np.random.random((N, 2))
+            actions = [i%2 for i in range(N-1)]
+            model = worldmodel.Worldmodel(method=method, seed=None)
+            model.add_data(data=data, actions=actions)
+            for _ in range(3):
+                model.split()
+                
+            tree = model.partitionings[0].tree
+            leaves = tree.get_leaves()
+            expected_labels = np.zeros(N, dtype=int)
+            for i, x in enumerate(data):
+                node = tree
+                while not node.is_leaf():
+                    node = node._children[node._test(x, params=node._split_params._test_params)]
+                expected_labels[i] = leaves.index(node)
+                
+            labels = tree.classify(data)
+            self.failUnless(np.array_equal(labels, expected_labels))
+            
+            # compiled tree
+            compiled_tree = model.partitionings[0].compiled_tree
+            self.failUnless(compiled_tree.get_number_of_leaves() == len(leaves))
+            labels = model.classify(data, action=0)
+            self.failUnless(np.array_equal(labels, expected_labels))
+            compiled_tree.rebuild(tree)
+            self.failUnless(np.array_equal(compiled_tree.classify(data), expected_labels))
+            self.failUnless(np.array_equal(labels, model.partitionings[0].labels))
+
+
+
 if __name__ == "__main__":
     unittest.main()
     
\ No newline at end of file
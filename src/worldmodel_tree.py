@@ -1,6 +1,8 @@
 import numpy as np
 import weakref
 
+import compiled_tree
+import growable_array
 import tree_structure
 
 
@@ -14,8 +16,15 @@ class WorldmodelTree(tree_structure.Tree):
         self._active_action = partitioning.active_action
         self.model = self._get_weakref_proxy(partitioning.model)
         
-        # indices of data belonging to this node
-        self.data_refs = np.empty(0, dtype=int)
+        # indices of data belonging to this node (unless they are kept in the
+        # contiguous layout of the partitioning)
+        self._data_refs = None
+        if not partitioning.contiguous_refs:
+            self._data_refs = growable_array.GrowableArray(dtype=int)
+            
+        # references of transitions strictly inside this (leaf) node, i.e., of 
+        # all references whose successor belongs to the node as well
+        self._inside_refs = growable_array.GrowableArray(dtype=int)
         
         # if node is split, parameters are stored here
         self._split_params = None
@@ -29,6 +38,60 @@ class WorldmodelTree(tree_structure.Tree):
         if type(ref) in weakref.ProxyTypes:
             return ref
         return weakref.proxy(ref)
+    
+    
+    @property
+    def data_refs(self):
+        """
+        Indices of the data belonging to this node (None for inner nodes).
+        """
+        if self._partitioning.contiguous_refs and self.is_leaf():
+            leaf_index = self.get_leaf_index()
+            return self._partitioning.get_data_refs(leaf_index, leaf_index+1)
+        if self._data_refs is None:
+            return None
+        return self._data_refs.get()
+    
+    
+    @data_refs.setter
+    def data_refs(self, refs):
+        if refs is None:
+            self._data_refs = None
+            return
+        self._data_refs = growable_array.GrowableArray(dtype=int)
+        self._data_refs.append(refs)
+        
+        
+    def add_data_refs(self, refs):
+        """
+        Appends references of new data to the node (in amortized O(1) per 
+        reference). The new references have to be labeled already and to be 
+        larger than all existing ones. In the contiguous layout the references 
+        are stored by the partitioning and only the transitions are updated 
+        here.
+        """
+        refs = np.asarray(refs, dtype=int)
+        if not self._partitioning.contiguous_refs:
+            self._data_refs.append(refs)
+            
+        # new transitions inside the node end in the new references
+        labels = self._partitioning.labels
+        refs_0 = refs[refs > 0] - 1
+        self._inside_refs.append(refs_0[labels[refs_0] == self.get_leaf_index()])
+        return
+    
+    
+    def _init_inside_refs(self):
+        """
+        Calculates the references of transitions inside the leaf from scratch
+        based on the labels of the partitioning.
+        """
+        labels = self._partitioning.labels
+        refs = self.data_refs
+        refs = refs[refs < len(labels) - 1]
+        self._inside_refs = growable_array.GrowableArray(dtype=int)
+        self._inside_refs.append(refs[labels[refs+1] == self.get_leaf_index()])
+        return
         
         
     def _calc_test_params(self, active_action, fast_partition=False):
@@ -46,32 +109,32 @@ class WorldmodelTree(tree_structure.Tree):
         """
         raise NotImplementedError("Use subclass like WorldmodelSpectral instead.")
     
+    
+    def _test_batch(self, X, params):
+        """
+        Tests to which child every row of the matrix X belongs and returns an
+        integer array. The default falls back to _test() row by row; 
+        subclasses should provide a vectorized version.
+        """
+        N = X.shape[0]
+        children = np.empty(N, dtype=int)
+        for i, x in enumerate(X):
+            children[i] = self._test(x, params=params)
+        return children
+    
 
     def classify(self, x):
         """
         Returns the state that x belongs to according to the current model. If
         x is a matrix, a list is returned containing a integer state for every
         row.
-        """
         
+        The tree is compiled for this (see CompiledTree), which sends the whole
+        matrix down the tree at once. Partitionings keep a compiled tree up to
+        date and should be used for repeated classification.
+        """
         assert self.get_root() is self
-        assert x.ndim == 2
-        
-        N, _ = x.shape
-        labels = np.zeros(N, dtype=int)
-        leaves = self.get_leaves()
-        node_indices = dict(zip(leaves, [leaf.get_leaf_index() for leaf in leaves]))
-        
-        for i, dat in enumerate(x):
-            
-            node = self
-            while not node.is_leaf():
-                child_index = node._test(dat, params=node._split_params._test_params)
-                node = node._children[child_index]
-                
-            labels[i] = node_indices[node]
-
-        return labels
+        return compiled_tree.CompiledTree(tree=self).classify(x)
             
             
     def get_number_of_samples(self):
@@ -84,20 +147,12 @@ class WorldmodelTree(tree_structure.Tree):
         data of sub-nodes is returned.
         """
         
-        model = self.model
-        model_data = model.data
-        dat_refs = sorted(self.get_data_refs())
-        N = len(dat_refs)
-        D = model.get_input_dim()
+        dat_refs = np.sort(self.get_data_refs())
         
-        if N == 0:
+        if len(dat_refs) == 0:
             return None
         
-        data = np.empty((N, D))
-        for i, ref in enumerate(dat_refs):
-            data[i] = model_data[ref]
-            
-        return data 
+        return self.model.get_data_for_refs(refs=dat_refs)
     
     
     #@profile
@@ -113,14 +168,18 @@ class WorldmodelTree(tree_structure.Tree):
         leaf_index = self.get_leaf_index()
         assert len(self.data_refs) == np.count_nonzero(self._partitioning.labels == leaf_index)
         self._partitioning.labels = split_params.get_new_labels()
-        self._partitioning.transitions = split_params.get_new_transition_matrices()
         
         # copy new references to children
         new_dat_refs = split_params.get_new_data_refs()
+        self._partitioning.set_transitions(split_params.get_new_transition_matrices(), split_index=leaf_index, split_weights=[len(refs) for refs in new_dat_refs])
         assert len(self.data_refs) == len(new_dat_refs[0]) + len(new_dat_refs[1])
         child_1, child_2 = super(WorldmodelTree, self).split(partitioning=self._partitioning)
-        child_1.data_refs = new_dat_refs[0]
-        child_2.data_refs = new_dat_refs[1]
+        self._partitioning.compiled_tree.split_leaf(leaf_index=leaf_index, test_params=split_params._test_params)
+        if self._partitioning.contiguous_refs:
+            self._partitioning.split_data_refs(leaf_index=leaf_index)
+        else:
+            child_1.data_refs = new_dat_refs[0]
+            child_2.data_refs = new_dat_refs[1]
         
         # 
         assert len(child_1.data_refs) == np.count_nonzero(self._partitioning.labels == leaf_index)
@@ -129,8 +188,18 @@ class WorldmodelTree(tree_structure.Tree):
         #assert False not in [model.partitionings[action].labels[ref]==leaf_index for ref in child_1.data_refs]
         #assert False not in [model.partitionings[action].labels[ref]==leaf_index+1 for ref in child_2.data_refs]
         
+        # transitions inside the children
+        child_1._init_inside_refs()
+        child_2._init_inside_refs()
+        self._partitioning._changed_leaves.update([child_1, child_2])
+        
         # free some memory
         self.data_refs = None
+        self._inside_refs = None
+        
+        # workers of the split pool repeat the split
+        if self.model._split_pool is not None:
+            self.model._split_pool.log_split(action=self._active_action, leaf_index=leaf_index, test_params=split_params._test_params)
         return child_1, child_2
     
 
@@ -143,6 +212,11 @@ class WorldmodelTree(tree_structure.Tree):
 
         if self.is_leaf():
             return self.data_refs
+        
+        # a slice of the contiguous layout
+        if self._partitioning.contiguous_refs:
+            first_leaf, last_leaf = self.get_leaf_range()
+            return self._partitioning.get_data_refs(first_leaf, last_leaf)
 
         # else        
         data_refs = np.empty(0, dtype=int)
@@ -160,6 +234,10 @@ class WorldmodelTree(tree_structure.Tree):
         and one for the end of the transition.
         """
         
+        # transitions inside leaves are book-kept
+        if self.is_leaf() and inside and not heading_in and not heading_out:
+            return self._inside_refs.get()
+        
         refs_1 = self.get_data_refs()
         refs_0 = refs_1 - 1
         N = self.model.get_number_of_samples()